@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('lib')
+sys.path.append('../lib')
+
+import models
+
+models.engine().execute("alter table users add column active_at timestamp")
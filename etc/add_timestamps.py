@@ -6,4 +6,4 @@ sys.path.append('../lib')
 
 import models
 
-models._engine.execute("alter table users add column created_at timestamp")
+models.engine().execute("alter table users add column created_at timestamp")
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Memory used by the user registry, with everyone active and with everyone
+hibernating.
+
+Each case runs in a fresh process that fills a UserRegistry with N users
+(two resources each, as from presence), optionally hibernates them all,
+and reports how much its resident set grew, scaled to 100k users.
+
+For a figure from before hibernation, copy this into an older tree and
+run "bench_hibernate.py --mode active" there, from a directory holding a
+twitterspy.conf like the one below.  It prints the growth in bytes.
+
+usage:  bench_hibernate.py [-n users]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONF = """[general]
+db: sqlite:///%(dir)s/bench.sqlite3
+admins: admin@example.com
+render_workers: 0
+
+[logging]
+level: info
+
+[xmpp]
+jid: twitterspy@example.com/bot
+pass: bench
+"""
+
+def rss():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    return 0
+
+def measure(mode, n):
+    """Run in the child:  print the RSS growth in bytes for n users."""
+    sys.path.insert(0, os.path.join(TOP, 'lib/twitty-twister/lib'))
+    sys.path.insert(0, os.path.join(TOP, 'lib/wokkel'))
+    sys.path.insert(0, os.path.join(TOP, 'lib'))
+    from twisted.python import log
+    log.startLogging(open(os.devnull, 'w'), setStdout=False)
+    from twitterspy import scheduling
+
+    r = scheduling.UserRegistry()
+    before = rss()
+    for i in xrange(n):
+        # Built fresh each time, as they'd arrive in stanzas.
+        bare = 'user%d@example.com' % i
+        for res in ('Home', 'Work'):
+            r.add(bare, '%s/%s' % (bare, res), 1000000 + i, 2000000 + i)
+        # In batches, as the hourly sweep would, so freed memory is reused.
+        if mode == 'hibernated' and i % 1000 == 999:
+            r.hibernate(now=2 ** 31)
+    if mode == 'hibernated':
+        r.hibernate(now=2 ** 31)
+        assert len(r) == n
+    else:
+        # Only users, so this case also runs on trees without hibernation.
+        assert len(r.users) == n
+    print rss() - before
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--users', type='int', default=100000)
+    parser.add_option('--mode', help=optparse.SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+
+    if opts.mode:
+        measure(opts.mode, opts.users)
+        return
+
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    open(os.path.join(scratch, 'twitterspy.conf'), 'w').write(
+        CONF % {'dir': scratch})
+    try:
+        results = {}
+        for mode in ('active', 'hibernated'):
+            out = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__),
+                 '--mode', mode, '-n', str(opts.users)],
+                cwd=scratch, stdout=subprocess.PIPE).communicate()[0]
+            results[mode] = int(out.split()[-1])
+            print "%-12s %8.1fMB per 100k users" % (
+                mode, results[mode] * 100000.0 / opts.users / (1 << 20))
+    finally:
+        shutil.rmtree(scratch)
+    if results['active']:
+        print "hibernated users take %.0f%% of the memory" % (
+            100.0 * results['hibernated'] / results['active'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the per-message hot paths.
+
+Each benchmark is run a few times and the best time per call is kept.
+Results can be saved and compared with an earlier run, so regressions
+between commits stand out:
+
+    bench_hotpaths.py -o before.txt
+    (change things)
+    bench_hotpaths.py -c before.txt -o after.txt
+
+Saved results are plain text, one "name seconds-per-call" line each.
+
+The benchmarks run in a scratch directory with their own config and
+sqlite database, so they can be run from anywhere.
+
+usage:  bench_hotpaths.py [-o results.txt] [-c previous.txt] [-n calls]
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import optparse
+import commands
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(TOP, 'lib/twitty-twister/lib'))
+sys.path.insert(0, os.path.join(TOP, 'lib/wokkel'))
+sys.path.insert(0, os.path.join(TOP, 'lib'))
+
+CONF = """[general]
+db: sqlite:///%(dir)s/bench.sqlite3
+admins: admin@example.com
+render_workers: 0
+
+[logging]
+level: info
+
+[xmpp]
+jid: twitterspy@example.com/bot
+pass: bench
+"""
+
+# Slower than this, compared to the previous run, is worth a look.
+THRESHOLD = 0.10
+
+BENCHMARKS = []
+
+# These hit the database, so they get a tenth of the calls.
+SLOW = ('by_jid', 'update_status', 'onMessage')
+
+def benchmark(f):
+    BENCHMARKS.append(f)
+    return f
+
+class Entry(object):
+    """Looks enough like a parsed search atom entry."""
+
+    class author(object):
+        pass
+
+    def __init__(self, i):
+        self.id = 'tag:search.twitter.com,2005:%d' % (1000000 + i)
+        self.author = Entry.author()
+        self.author.name = 'user%d (Some User)' % i
+        self.author.uri = 'http://twitter.com/user%d' % i
+        self.title = 'status %d about things &amp; stuff' % i
+        self.content = 'status %d about &lt;b&gt;things&lt;/b&gt;' % i
+
+@benchmark
+def gotResult(n):
+    from twitterspy import scheduling
+    entries = [Entry(i) for i in range(n)]
+    c = scheduling.SearchCollector()
+    return lambda i: c.gotResult(entries[i])
+
+@benchmark
+def bare_jids(n):
+    from twisted.words.protocols.jabber.jid import JID
+    from twitterspy import scheduling
+    js = scheduling.JidSet()
+    for i in range(200):
+        j = 'user%d@example.com/res%d' % (i, i % 3)
+        js.add(j)
+        # A quarter dnd, so filtering has something to do.
+        scheduling.presence.update(JID(j), 'dnd' if i % 4 == 0 else None, 0)
+    return lambda i: js.bare_jids()
+
+def _protocol():
+    from twitterspy import protocol
+    p = protocol.TwitterspyMessageProtocol()
+    p.send = lambda msg: None
+    p.send_plain = lambda jid, msg: None
+    p.send_html = lambda jid, body, html: None
+    return p
+
+@benchmark
+def dedup_key(n):
+    p = _protocol()
+    keys = ['%d@user%d@example.com/Home Desktop' % (i, i % 100)
+            for i in range(n)]
+    return lambda i: p._dedup_key(keys[i])
+
+@benchmark
+def current_mood(n):
+    from twitterspy import moodiness
+    m = moodiness.Moodiness()
+    for i in range(5000):
+        m.record('search', random.choice((moodiness.OK, moodiness.OK,
+                                          moodiness.RATE_LIMIT)))
+    return lambda i: m.current_mood()
+
+@benchmark
+def QueryRegistry_remove(n):
+    from twitterspy import scheduling
+    r = scheduling.QueryRegistry()
+    words = ['word%d' % i for i in range(500)]
+    users = ['user%d@example.com/res' % i for i in range(n)]
+    for u in users:
+        for w in random.sample(words, 3):
+            r.add(u, w, 0)
+    return lambda i: r.remove(users[i])
+
+@benchmark
+def command_lookup(n):
+    from twitterspy import xmpp_commands
+    bodies = ['track some thing', 'untrack x', 'tracks', 'status', 'on',
+              '@someone hi', 'nonsense words']
+    def dispatch(i):
+        a = bodies[i % len(bodies)].strip().split(None, 1)
+        return xmpp_commands.all_commands.lookup(a[0].lower())
+    return dispatch
+
+def _database():
+    import models
+    models._metadata.create_all(models.engine())
+    with models.Session() as session:
+        for i in range(10):
+            models.User.update_status('user%d@example.com' % i, 'online',
+                                      session)
+        session.commit()
+    return models
+
+@benchmark
+def by_jid(n):
+    models = _database()
+    session = models.Session()
+    return lambda i: models.User.by_jid('user%d@example.com' % (i % 10),
+                                        session)
+
+@benchmark
+def update_status(n):
+    models = _database()
+    return lambda i: models.User.update_status(
+        'user%d@example.com' % (i % 10), ('online', 'away')[i % 2])
+
+@benchmark
+def onMessage(n):
+    from twisted.words.xish import domish
+    _database()
+    p = _protocol()
+    msgs = []
+    for i, body in enumerate(['tracks', 'status', 'nonsense words']):
+        m = domish.Element((None, 'message'))
+        m['type'] = 'chat'
+        m['from'] = 'user%d@example.com/res' % i
+        m.addElement('body', content=body)
+        msgs.append(m)
+    return lambda i: p._TwitterspyMessageProtocol__onMessage(msgs[i % 3])
+
+def run(f, n, repeat=3):
+    best = None
+    for r in range(repeat):
+        op = f(n)
+        start = time.time()
+        for i in xrange(n):
+            op(i)
+        elapsed = (time.time() - start) / n
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def save(path, results):
+    f = open(path, 'w')
+    f.write("# %s, python %s, %s\n" % (
+        commands.getoutput('cd %s && git describe --always --dirty' % TOP),
+        sys.version.split()[0], time.ctime()))
+    for name in sorted(results):
+        f.write("%s %.9f\n" % (name, results[name]))
+    f.close()
+
+def load(path):
+    results = {}
+    for line in open(path):
+        if line.strip() and not line.startswith('#'):
+            name, t = line.split()
+            results[name] = float(t)
+    return results
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-o', '--output', help="save results here")
+    parser.add_option('-c', '--compare', help="compare with these results")
+    parser.add_option('-n', '--calls', type='int', default=2000)
+    parser.add_option('-k', '--only', help="only benchmarks containing this")
+    opts, args = parser.parse_args()
+
+    previous = {}
+    if opts.compare:
+        previous = load(opts.compare)
+
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    open(os.path.join(scratch, 'twitterspy.conf'), 'w').write(
+        CONF % {'dir': scratch})
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    # The log goes nowhere, as under twistd without -n.
+    from twisted.python import log
+    log.startLogging(open(os.devnull, 'w'), setStdout=False)
+    random.seed(1)
+
+    results = {}
+    regressions = 0
+    try:
+        for f in BENCHMARKS:
+            name = f.__name__
+            if opts.only and opts.only not in name:
+                continue
+            n = opts.calls if name not in SLOW else opts.calls / 10
+            t = run(f, n)
+            results[name] = t
+            line = "%-22s %10.2fus" % (name, t * 1e6)
+            if name in previous:
+                change = t / previous[name] - 1
+                line += "  was %10.2fus  %+6.1f%%" % (previous[name] * 1e6,
+                                                     change * 100)
+                if change > THRESHOLD:
+                    line += "  SLOWER"
+                    regressions += 1
+            print line
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+    if opts.output:
+        save(opts.output, results)
+    if regressions:
+        print "%d benchmarks more than %d%% slower" % (regressions,
+                                                       THRESHOLD * 100)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
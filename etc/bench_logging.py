@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Compare the cost of hot path logging through log.msg and slog.
+
+Logs go to /dev/null through twisted's file observer, as they would to a
+log file under twistd.
+
+The twitterspy.conf in the current directory is used if there is one,
+otherwise a copy of twitterspy.conf.sample, so it can be run from
+anywhere in the tree.
+
+usage:  bench_logging.py [messages]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(TOP, 'lib'))
+
+from twisted.python import log
+
+def load_config():
+    """Import the config, from the sample if there's none here."""
+    if os.path.exists('twitterspy.conf'):
+        from twitterspy import config
+        return
+    here = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    shutil.copy(os.path.join(TOP, 'twitterspy.conf.sample'),
+                os.path.join(scratch, 'twitterspy.conf'))
+    try:
+        os.chdir(scratch)
+        from twitterspy import config
+    finally:
+        os.chdir(here)
+        shutil.rmtree(scratch)
+
+def timed(name, f, n):
+    start = time.time()
+    for i in xrange(n):
+        f(i)
+    elapsed = time.time() - start
+    print "%-32s %8.0f msgs/s  %6.2fus each" % (name, n / elapsed,
+                                                  elapsed * 1e6 / n)
+
+def main(n=200000):
+    load_config()
+    from twitterspy import slog
+    log.startLogging(open(os.devnull, 'w'), setStdout=False)
+    key = '12345@user@example.com'
+
+    timed("log.msg", lambda i: log.msg("Sending %s" % key), n)
+
+    off = slog.Category('bench', level=slog.INFO)
+    timed("slog debug, disabled", lambda i: off.debug("Sending %s", key), n)
+
+    sampled = slog.Category('bench', level=slog.DEBUG, sample=0.01)
+    timed("slog debug, 1% sampled",
+          lambda i: sampled.debug("Sending %s", key), n)
+
+    limited = slog.Category('bench', level=slog.DEBUG, rate=100)
+    timed("slog debug, 100/s rate limit",
+          lambda i: limited.debug("Sending %s", key), n)
+
+    full = slog.Category('bench', level=slog.DEBUG)
+    timed("slog debug, enabled", lambda i: full.debug("Sending %s", key), n)
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Benchmark the local track matcher.
+
+Compiles a synthetic set of tracks and times matching statuses against it.
+
+usage:  bench_matcher.py [tracks] [statuses]
+"""
+
+import sys
+sys.path.append('lib/twitterspy')
+sys.path.append('../lib/twitterspy')
+
+import time
+import random
+
+import canonical
+import matcher
+
+def vocabulary(n, r):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(r.choice(letters) for i in range(r.randint(3, 9)))
+            for i in range(n)]
+
+def make_tracks(n, vocab, r):
+    rv = set()
+    while len(rv) < n:
+        kind = r.random()
+        if kind < 0.6:
+            q = r.choice(vocab)
+        elif kind < 0.8:
+            q = ' '.join(r.sample(vocab, 2))
+        elif kind < 0.9:
+            q = '"%s"' % ' '.join(r.sample(vocab, 2))
+        elif kind < 0.95:
+            q = '%s OR %s' % tuple(r.sample(vocab, 2))
+        else:
+            q = '%s -%s' % tuple(r.sample(vocab, 2))
+        rv.add(canonical.canonicalize(q))
+    return list(rv)
+
+def main(ntracks=100000, nstatuses=20000):
+    r = random.Random(42)
+    vocab = vocabulary(ntracks, r)
+    tracks = make_tracks(ntracks, vocab, r)
+    statuses = [' '.join(r.choice(vocab) for i in range(r.randint(5, 20)))
+                for i in range(nstatuses)]
+
+    start = time.time()
+    m = matcher.Matcher(tracks)
+    built = time.time() - start
+    print "Compiled %d tracks in %.2fs" % (len(tracks), built)
+
+    hits = 0
+    start = time.time()
+    for s in statuses:
+        hits += len(m.match(s))
+    elapsed = time.time() - start
+    print ("Matched %d statuses in %.2fs (%.0f statuses/s, %.0fus each, "
+           "%.2f matches per status)"
+           % (nstatuses, elapsed, nstatuses / elapsed,
+              elapsed * 1e6 / nstatuses, float(hits) / nstatuses))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Measure reactor latency while rendering search results, with the render
+pool off and on.
+
+A timer ticks every 10ms while batches of synthetic search entries are
+rendered; how late the ticks fire is the delay presence handling and pings
+would see.
+
+usage:  bench_render.py [workers] [batches] [batch size]
+"""
+
+import sys
+sys.path.append('lib/twitterspy')
+sys.path.append('../lib/twitterspy')
+
+import time
+
+from twisted.internet import reactor, task, defer
+
+import rendering
+
+TICK = 0.01
+
+def entries(n):
+    return [(i, 'user%d Some Name' % i, 'http://twitter.com/user%d' % i,
+             'status %d about things &amp; stuff' % i,
+             'status %d about &lt;b&gt;things&lt;/b&gt; &amp; stuff' % i)
+            for i in range(n)]
+
+@defer.inlineCallbacks
+def run(workers, batches, size):
+    renderer = rendering.Renderer(workers)
+    renderer.start()
+    lags = []
+    last = [time.time()]
+    def tick():
+        now = time.time()
+        lags.append(now - last[0] - TICK)
+        last[0] = now
+    loop = task.LoopingCall(tick)
+    loop.start(TICK, now=False)
+
+    batch = entries(size)
+    start = time.time()
+    for i in range(batches):
+        yield renderer.render(rendering.render_search, batch)
+        # Let the timer run between batches as the pollers would.
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        yield d
+    elapsed = time.time() - start
+    loop.stop()
+    renderer.stop()
+
+    lags.sort()
+    pct = lambda p: lags[min(len(lags) - 1, int(len(lags) * p))] * 1000
+    print ("workers=%d: %d batches of %d in %.2fs; reactor lag p50=%.1fms "
+           "p99=%.1fms max=%.1fms"
+           % (workers, batches, size, elapsed, pct(0.5), pct(0.99),
+              lags[-1] * 1000))
+
+@defer.inlineCallbacks
+def main(workers=4, batches=200, size=500):
+    yield run(0, batches, size)
+    yield run(workers, batches, size)
+    reactor.stop()
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main, *[int(a) for a in sys.argv[1:]])
+    reactor.run()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Time loading twitterspy.tac in a fresh interpreter.
+
+Each run reports the time to import each of twitterspy's modules and to
+evaluate the whole tac, as twistd does before starting the reactor, and
+the total of those.  Run from the directory holding twitterspy.tac and
+twitterspy.conf.  Without a VERSION file there (twitterspy.start writes
+one), the tac's version lookup runs git describe.
+
+usage:  bench_startup.py [runs]
+"""
+
+import sys
+import subprocess
+
+MODULES = ['twisted.internet.reactor', 'wokkel.client', 'twitter', 'models',
+           'twitterspy.config', 'twitterspy.scheduling',
+           'twitterspy.protocol', 'twitterspy.xmpp_commands']
+
+PROBE = r"""
+import sys, time
+sys.path.insert(0, "lib/twitty-twister/lib")
+sys.path.insert(0, "lib/wokkel")
+sys.path.insert(0, "lib")
+for m in %r:
+    t = time.time()
+    __import__(m)
+    print "%%s %%f" %% (m, time.time() - t)
+t = time.time()
+execfile("twitterspy.tac", {"__file__": "twitterspy.tac"})
+print "twitterspy.tac %%f" %% (time.time() - t)
+""" % MODULES
+
+def main(runs=5):
+    totals = {}
+    order = []
+    for i in range(runs):
+        out = subprocess.Popen([sys.executable, '-c', PROBE],
+                               stdout=subprocess.PIPE).communicate()[0]
+        run = 0
+        for line in out.splitlines():
+            name, t = line.rsplit(' ', 1)
+            if name not in totals:
+                order.append(name)
+            totals.setdefault(name, []).append(float(t))
+            run += float(t)
+        totals.setdefault('total', []).append(run)
+    order.append('total')
+    for name in order:
+        ts = sorted(totals[name])
+        print "%-28s median %7.1fms  min %7.1fms" % (
+            name, ts[len(ts) / 2] * 1000, ts[0] * 1000)
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
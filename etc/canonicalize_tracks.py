@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Move existing tracks to their canonical form.
+
+Each user's original query is kept in user_tracks.display, and tracks that
+canonicalize to the same query are merged into one row (along with any
+user's subscriptions to more than one of them).
+"""
+
+import sys
+sys.path.append('lib')
+sys.path.append('../lib')
+
+from sqlalchemy import text
+
+import models
+from twitterspy import canonical
+
+e = models.engine()
+
+# Bind parameters rather than ? so this works on any database.
+_repoint = text("update user_tracks set track_id = :keep where track_id = :old")
+_drop_track = text("delete from tracks where id = :old")
+# After merging, a user who tracked two spellings has two rows for one
+# track;  keep the first.
+_drop_dups = text("""delete from user_tracks where track_id = :keep
+    and id not in (select min(id) from user_tracks where track_id = :keep
+                   group by user_id)""")
+_set_track = text(
+    "update tracks set query = :query, max_seen = :max_seen where id = :keep")
+
+e.execute("alter table user_tracks add column display varchar")
+e.execute("""update user_tracks set display =
+    (select query from tracks where tracks.id = user_tracks.track_id)""")
+
+groups = {}
+for tid, query, max_seen in e.execute(
+    "select id, query, max_seen from tracks order by id").fetchall():
+    groups.setdefault(canonical.canonicalize(query), []).append(
+        (tid, query, max_seen))
+
+for canon, rows in groups.items():
+    kid, kquery, kmax = rows[0]
+    for tid, query, max_seen in rows[1:]:
+        e.execute(_repoint, keep=kid, old=tid)
+        e.execute(_drop_track, old=tid)
+        kmax = max(kmax, max_seen)
+    if len(rows) > 1:
+        e.execute(_drop_dups, keep=kid)
+    e.execute(_set_track, query=canon, max_seen=kmax, keep=kid)
@@ -10,4 +10,4 @@ sys.path.append('../lib')
 
 import models
 
-models._metadata.create_all(models._engine)
+models._metadata.create_all(models.engine())
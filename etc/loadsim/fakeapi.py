@@ -0,0 +1,149 @@
+"""
+A stand-in for the parts of the twitter API twitterspy polls.
+
+Search answers in atom, the friends timeline and direct messages in XML,
+after a configurable delay, failing some fraction of calls with a 502 or a
+rate limit.  Each status carries the time it was made up as a [t=...]
+marker so delivery latency can be measured at the other end.
+"""
+
+import time
+import random
+from xml.sax.saxutils import escape
+
+from twisted.web import resource, server
+from twisted.internet import reactor
+
+class Stats(object):
+
+    def __init__(self):
+        self.calls = {}
+        self.errors = {}
+        self.statuses = 0
+
+    def called(self, endpoint):
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def failed(self, endpoint):
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+class FakeTwitter(resource.Resource):
+    """
+    latency -- mean seconds before answering (exponentially distributed)
+    error_rate -- fraction of calls that fail
+    results -- mean new statuses per search
+    private -- mean new statuses per timeline or direct message poll
+    """
+
+    isLeaf = True
+
+    def __init__(self, latency=0.2, error_rate=0.01, results=2, private=1):
+        resource.Resource.__init__(self)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.results = results
+        self.private = private
+        self.stats = Stats()
+        self.next_id = 1000
+
+    def _count(self, mean):
+        # Roughly poisson without pulling in numpy.
+        n = 0
+        limit = random.expovariate(1.0)
+        while mean > 0 and limit < mean:
+            n += 1
+            limit += random.expovariate(1.0)
+        return n
+
+    def _ids(self, n):
+        ids = range(self.next_id, self.next_id + n)
+        self.next_id += n
+        ids.reverse()
+        return ids
+
+    def _text(self, words):
+        return "%s lorem ipsum [t=%.4f]" % (words, time.time())
+
+    def render_GET(self, request):
+        path = request.path
+        if path.endswith('search.atom'):
+            endpoint = 'search'
+        elif path.endswith('friends_timeline.xml'):
+            endpoint = 'friends'
+        elif path.endswith('direct_messages.xml'):
+            endpoint = 'direct'
+        else:
+            request.setResponseCode(404)
+            return "not here"
+        self.stats.called(endpoint)
+        delay = random.expovariate(1.0 / self.latency) if self.latency else 0
+        reactor.callLater(delay, self._answer, request, endpoint)
+        return server.NOT_DONE_YET
+
+    def _answer(self, request, endpoint):
+        if request.finished or getattr(request, '_disconnected', False):
+            return
+        if random.random() < self.error_rate:
+            self.stats.failed(endpoint)
+            if random.random() < 0.5:
+                request.setResponseCode(502)
+            else:
+                request.setResponseCode(420)
+            request.write("try again later")
+        else:
+            request.setHeader('content-type', 'application/xml')
+            request.write(getattr(self, '_' + endpoint)(request))
+        request.finish()
+
+    def _search(self, request):
+        q = request.args.get('q', [''])[0]
+        entries = []
+        for i in self._ids(self._count(self.results)):
+            author = 'tweeter%d' % random.randint(1, 10000)
+            text = escape(self._text(q))
+            entries.append("""<entry>
+<id>tag:search.twitter.com,2005:%d</id>
+<published>2009-01-01T00:00:00Z</published>
+<title>%s</title>
+<content type="html">%s</content>
+<author><name>%s (Some Tweeter)</name><uri>http://twitter.com/%s</uri></author>
+</entry>""" % (i, text, text, author, author))
+        self.stats.statuses += len(entries)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<feed xmlns="http://www.w3.org/2005/Atom">\n%s\n</feed>'
+                % '\n'.join(entries))
+
+    def _user(self, tag, name):
+        return ("<%s><id>%d</id><name>%s</name><screen_name>%s</screen_name>"
+                "</%s>" % (tag, hash(name) & 0xffffff, name, name, tag))
+
+    def _friends(self, request):
+        statuses = []
+        for i in self._ids(self._count(self.private)):
+            author = 'friend%d' % random.randint(1, 1000)
+            statuses.append("<status><id>%d</id><text>%s</text>%s</status>"
+                            % (i, escape(self._text('hello')),
+                               self._user('user', author)))
+        self.stats.statuses += len(statuses)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<statuses type="array">%s</statuses>' % ''.join(statuses))
+
+    def _direct(self, request):
+        messages = []
+        for i in self._ids(self._count(self.private / 10.0)):
+            sender = 'friend%d' % random.randint(1, 1000)
+            messages.append("<direct_message><id>%d</id><text>%s</text>%s"
+                            "</direct_message>"
+                            % (i, escape(self._text('psst')),
+                               self._user('sender', sender)))
+        self.stats.statuses += len(messages)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<direct-messages type="array">%s</direct-messages>'
+                % ''.join(messages))
+
+def listen(port=0, **kwargs):
+    """Start a fake twitter.  Returns (FakeTwitter, listening port)."""
+    api = FakeTwitter(**kwargs)
+    site = server.Site(api)
+    site.noisy = False
+    return api, reactor.listenTCP(port, site, interface='127.0.0.1')
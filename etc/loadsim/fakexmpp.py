@@ -0,0 +1,310 @@
+"""
+Just enough of an XMPP server and memcached to run twitterspy against.
+
+The XMPP server takes any SASL PLAIN login, binds whatever resource is
+asked for, and once the bot is available, has a synthetic population of
+users come online.  Chat messages sent to them are swallowed, and the age
+of any [t=...] marker in them is recorded as delivery latency.  Several
+bot workers can be logged in at once, and users can be made to send them
+commands.
+"""
+
+import re
+import time
+import base64
+import random
+
+from twisted.internet import reactor
+from twisted.protocols import basic
+from twisted.internet import protocol
+from twisted.words.xish import domish
+from twisted.words.protocols.jabber import xmlstream, jid
+
+NS_CLIENT = 'jabber:client'
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+
+MARKER = re.compile(r'\[t=(\d+\.\d+)\]')
+
+class Deliveries(object):
+
+    def __init__(self):
+        self.messages = 0
+        self.latencies = []
+        self.recipients = set()
+        # worker resource -> bare jids it delivered to
+        self.by_worker = {}
+
+    def received(self, to, body, worker=None):
+        now = time.time()
+        self.messages += 1
+        bare = to.split('/', 1)[0]
+        self.recipients.add(bare)
+        self.by_worker.setdefault(worker, set()).add(bare)
+        for t in MARKER.findall(body):
+            self.latencies.append(now - float(t))
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        l = sorted(self.latencies)
+        return l[min(len(l) - 1, int(len(l) * p / 100.0))]
+
+class Commands(object):
+    """Status commands sent on users' behalf, and the replies to them."""
+
+    def __init__(self):
+        self.next_id = 1
+        # bare jid -> [(sent at, worker it was given to)], oldest first
+        self.outstanding = {}
+        self.sent = 0
+        # (worker given to, worker that answered, seconds taken)
+        self.answered = []
+
+    def send(self, bare, worker):
+        self.sent += 1
+        self.outstanding.setdefault(bare, []).append((time.time(), worker))
+        self.next_id += 1
+        return 'cmd%d' % self.next_id
+
+    def replied(self, to, worker):
+        bare = to.split('/', 1)[0]
+        pending = self.outstanding.get(bare)
+        if pending:
+            sent, given = pending.pop(0)
+            if not pending:
+                del self.outstanding[bare]
+            self.answered.append((given, worker, time.time() - sent))
+
+class Authenticator(xmlstream.ListenAuthenticator):
+
+    namespace = NS_CLIENT
+    authenticated = False
+
+    def streamStarted(self, rootElement):
+        xmlstream.ListenAuthenticator.streamStarted(self, rootElement)
+        self.xmlstream.sendHeader()
+        features = domish.Element((xmlstream.NS_STREAMS, 'features'))
+        if self.authenticated:
+            features.addElement((NS_BIND, 'bind'))
+            features.addElement((NS_SESSION, 'session'))
+        else:
+            mechanisms = features.addElement((NS_SASL, 'mechanisms'))
+            mechanisms.addElement('mechanism', content='PLAIN')
+            self.xmlstream.addOnetimeObserver(
+                "/auth[@xmlns='%s']" % NS_SASL, self.onAuth)
+        self.xmlstream.send(features)
+
+    def onAuth(self, element):
+        self.authenticated = True
+        try:
+            self.xmlstream.username = base64.b64decode(
+                str(element)).split('\0')[1]
+        except (TypeError, IndexError):
+            pass
+        self.xmlstream.send(domish.Element((NS_SASL, 'success')))
+        self.xmlstream.reset()
+
+class Server(object):
+    """
+    users -- how many users come online
+    domain -- their domain, user1@domain and so on
+    login_rate -- users coming online per second
+
+    Any number of bot workers can log in to the same account with their own
+    resources.  Like a real server, each sees the others' presence, chats
+    between them are routed by full JID, users' presence goes to all of
+    them, and a chat to the account's bare JID goes to just one.
+    """
+
+    def __init__(self, users, domain='sim.example', login_rate=50):
+        self.users = users
+        self.domain = domain
+        self.login_rate = login_rate
+        self.deliveries = Deliveries()
+        self.commands = Commands()
+        # resource -> stream, for bound workers
+        self.streams = {}
+        # resource -> worker JID, for workers that have sent presence
+        self.available = {}
+        self.online = []
+        self.logging_in = False
+
+    def jids(self):
+        return ['user%d@%s' % (i, self.domain) for i in range(self.users)]
+
+    def buildStream(self, xs):
+        xs.addObserver('/iq', self.onIq, xs=xs)
+        xs.addObserver('/presence', self.onPresence, xs=xs)
+        xs.addObserver('/message', self.onMessage, xs=xs)
+        xs.addObserver(xmlstream.STREAM_END_EVENT, self.onEnd, xs=xs)
+
+    def onIq(self, iq, xs):
+        if iq.getAttribute('type') not in ('get', 'set'):
+            return
+        response = domish.Element((None, 'iq'))
+        response['type'] = 'result'
+        response['id'] = iq.getAttribute('id', '')
+        if iq.hasAttribute('to'):
+            response['from'] = iq['to']
+        bind = iq.firstChildElement()
+        if bind is not None and bind.uri == NS_BIND:
+            resource = bind.resource and unicode(bind.resource) or 'bot'
+            xs.bot = jid.JID(tuple=(getattr(xs, 'username', 'bot'),
+                                    self.domain, resource))
+            self.streams[resource] = xs
+            response.addElement((NS_BIND, 'bind')).addElement(
+                'jid', content=xs.bot.full())
+        xs.send(response)
+
+    def _user_presence(self, user, bot, available=True):
+        p = domish.Element((None, 'presence'))
+        p['from'] = user + '/sim'
+        p['to'] = bot.full()
+        if available:
+            p.addElement('priority', content='0')
+        else:
+            p['type'] = 'unavailable'
+        return p
+
+    def _peer_presence(self, peer, bot, available=True):
+        p = domish.Element((None, 'presence'))
+        p['from'] = peer.full()
+        p['to'] = bot.full()
+        if not available:
+            p['type'] = 'unavailable'
+        return p
+
+    def onPresence(self, presence, xs):
+        # Only broadcast presence matters here.
+        bot = getattr(xs, 'bot', None)
+        if presence.hasAttribute('to') or bot is None:
+            return
+        if presence.getAttribute('type') not in (None, 'available'):
+            return
+        if bot.resource in self.available:
+            return
+        for peer in self.available.values():
+            xs.send(self._peer_presence(peer, bot))
+            self.streams[peer.resource].send(self._peer_presence(bot, peer))
+        self.available[bot.resource] = bot
+        for user in self.online:
+            xs.send(self._user_presence(user, bot))
+        # The first worker's presence is the cue to bring users in.
+        if not self.logging_in:
+            self.logging_in = True
+            self._login(self.jids())
+
+    def onEnd(self, reason, xs):
+        bot = getattr(xs, 'bot', None)
+        if bot is None or self.streams.get(bot.resource) is not xs:
+            return
+        del self.streams[bot.resource]
+        if self.available.pop(bot.resource, None):
+            for peer in self.available.values():
+                self.streams[peer.resource].send(
+                    self._peer_presence(bot, peer, False))
+
+    def _login(self, jids):
+        for j in jids[:self.login_rate]:
+            self.online.append(j)
+            for bot in self.available.values():
+                self.streams[bot.resource].send(self._user_presence(j, bot))
+        if jids[self.login_rate:]:
+            reactor.callLater(1, self._login, jids[self.login_rate:])
+
+    def command(self, user, body='status'):
+        """Have a user send a command to the bot's bare JID.
+
+        It goes to one worker, picked at random.  Returns that worker."""
+        if not self.available:
+            return None
+        worker = random.choice(self.available.keys())
+        bot = self.available[worker]
+        m = domish.Element((None, 'message'))
+        m['from'] = user + '/sim'
+        m['to'] = bot.userhost()
+        m['type'] = 'chat'
+        m['id'] = self.commands.send(user, worker)
+        m.addElement('body', content=body)
+        self.streams[worker].send(m)
+        return worker
+
+    def onMessage(self, message, xs):
+        if message.getAttribute('type') == 'error':
+            return
+        bot = getattr(xs, 'bot', None)
+        to = message.getAttribute('to', '')
+        body = message.body and unicode(message.body) or u''
+        if bot is not None:
+            # As servers do, stamp who it's really from.
+            message['from'] = bot.full()
+            target = jid.JID(to)
+            if target.userhost() == bot.userhost():
+                peer = self.streams.get(target.resource)
+                if peer is not None:
+                    peer.send(message)
+                return
+        worker = bot and bot.resource
+        if body.startswith('Jid:'):
+            self.commands.replied(to, worker)
+        self.deliveries.received(to, body, worker)
+
+class FakeXMPPFactory(xmlstream.XmlStreamServerFactory):
+
+    def __init__(self, server):
+        xmlstream.XmlStreamServerFactory.__init__(self, Authenticator)
+        self.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, server.buildStream)
+
+class Memcache(basic.LineReceiver):
+    """add, set, get and delete; nothing expires."""
+
+    pending = None
+
+    def lineReceived(self, line):
+        if self.pending:
+            cmd, key = self.pending
+            self.pending = None
+            if cmd == 'add' and key in self.factory.data:
+                self.sendLine('NOT_STORED')
+            else:
+                self.factory.data[key] = line
+                self.sendLine('STORED')
+            return
+        parts = line.split()
+        if not parts:
+            return
+        cmd = parts[0]
+        if cmd in ('add', 'set'):
+            self.pending = (cmd, parts[1])
+        elif cmd == 'get':
+            for k in parts[1:]:
+                if k in self.factory.data:
+                    v = self.factory.data[k]
+                    self.sendLine('VALUE %s 0 %d' % (k, len(v)))
+                    self.sendLine(v)
+            self.sendLine('END')
+        elif cmd == 'delete':
+            if self.factory.data.pop(parts[1], None) is None:
+                self.sendLine('NOT_FOUND')
+            else:
+                self.sendLine('DELETED')
+        else:
+            self.sendLine('ERROR')
+
+class MemcacheFactory(protocol.ServerFactory):
+
+    protocol = Memcache
+
+    def __init__(self):
+        self.data = {}
+
+def listen(users, **kwargs):
+    """Start the fake XMPP server and memcached.
+
+    Returns (Server, xmpp listening port, memcache listening port)."""
+    server = Server(users, **kwargs)
+    xp = reactor.listenTCP(0, FakeXMPPFactory(server), interface='127.0.0.1')
+    mp = reactor.listenTCP(0, MemcacheFactory(), interface='127.0.0.1')
+    return server, xp, mp
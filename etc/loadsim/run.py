@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Run twitterspy end to end against a fake twitter and a fake XMPP server.
+
+A scratch directory gets a config pointing at the fakes and a database
+with a synthetic population: N users sharing M tracks (a few popular ones,
+a long tail of the rest), some of them with twitter credentials so their
+timelines and direct messages get polled.  twitterspy.tac is then run
+under twistd for the given time, and the API calls per hour, delivery
+latency and the bot's CPU and memory use are reported.
+
+Searches come round every 15 minutes, so runs shorter than that only see
+part of a cycle and the hourly numbers are extrapolated.
+
+With --workers, that many bots run as shards of one account, each in its
+own directory under the scratch one.  Users send status commands to the
+bot's bare JID, which the fake server gives to one worker at random, and
+--kill-after stops the last worker partway through, so the report shows
+commands answered whichever worker got them and the others taking over
+the stopped one's users.
+
+usage:  etc/loadsim/run.py [options]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import optparse
+
+from twisted.internet import reactor, protocol, task
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(os.path.dirname(HERE))
+
+sys.path.insert(0, HERE)
+
+import fakeapi
+import fakexmpp
+
+CONF = """[general]
+db: sqlite:///%(dir)s/loadsim.sqlite3
+admins: admin@%(domain)s
+memcache: 127.0.0.1:%(memcache)d
+max_requests: %(max_requests)d
+digest_threshold: 5
+render_workers: 0
+metrics_port: 0
+stall_threshold: 0.5
+
+[logging]
+level: info
+
+[twitter]
+base_url: http://127.0.0.1:%(api)d
+search_url: http://127.0.0.1:%(api)d/search.atom
+
+[xmpp]
+jid: twitterspy@%(domain)s/bot
+pass: loadsim
+host: 127.0.0.1
+port: %(xmpp)d
+"""
+
+SHARD = """
+[shard]
+name: %s
+"""
+
+WORDS = """apple banana cherry delta echo foxtrot golf hotel india juliet
+kilo lima mike november oscar papa quebec romeo sierra tango uniform victor
+whiskey xray yankee zulu python twisted xmpp jabber sqlite memcache""".split()
+
+def make_tracks(m):
+    """M distinct queries, mostly one or two words."""
+    tracks = set()
+    while len(tracks) < m:
+        n = random.choice((1, 1, 1, 2, 2, 3))
+        words = random.sample(WORDS, n)
+        if len(tracks) > len(WORDS) ** 2:
+            words.append('w%d' % len(tracks))
+        tracks.add(' '.join(sorted(words)))
+    return sorted(tracks)
+
+def populate(users, tracks, per_user, private, domain):
+    """Fill a fresh database.  Run from the scratch directory."""
+    import base64
+    import models
+    from twitterspy import canonical
+
+    e = models.engine()
+    models._metadata.create_all(e)
+    queries = make_tracks(tracks)
+    e.execute(models._tracks_table.insert(),
+              [{'id': i + 1, 'query': canonical.canonicalize(q),
+                'max_seen': 0} for i, q in enumerate(queries)])
+    rows = []
+    for i in range(users):
+        row = {'id': i + 1, 'jid': 'user%d@%s' % (i, domain),
+               'active': True, 'status': 'online', 'min_id': 0,
+               'username': None, 'password': None}
+        if random.random() < private:
+            row['username'] = 'user%d' % i
+            row['password'] = base64.encodestring('secret').strip()
+        rows.append(row)
+    e.execute(models._users_table.insert(), rows)
+    links = []
+    for i in range(users):
+        # Half pareto skewed, so a few tracks are watched by lots of people.
+        chosen = set()
+        while len(chosen) < min(per_user, tracks):
+            if random.random() < 0.5:
+                chosen.add(min(tracks - 1, int(random.paretovariate(1.2)) - 1))
+            else:
+                chosen.add(random.randrange(tracks))
+        for t in chosen:
+            links.append({'user_id': i + 1, 'track_id': t + 1,
+                          'display': queries[t]})
+    e.execute(models._usertrack_table.insert(), links)
+    return len(links)
+
+class Bot(protocol.ProcessProtocol):
+    """One twitterspy process.  The run ends when any of them exits
+    unasked, or all of them have been stopped."""
+
+    stopping = False
+    ended = None
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+
+    def processEnded(self, reason):
+        self.ended = reason
+        if reactor.running and (not self.stopping
+                                or all(b.ended for b in self.fleet)):
+            reactor.stop()
+
+class Usage(object):
+    """CPU and memory of a process, from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.hz = os.sysconf('SC_CLK_TCK')
+        self.started = time.time()
+        self.cpu_start = self.cpu()
+        self.rss = []
+
+    def cpu(self):
+        fields = open('/proc/%d/stat' % self.pid).read().rsplit(')', 1)[1]
+        fields = fields.split()
+        return (int(fields[11]) + int(fields[12])) / float(self.hz)
+
+    def status(self, key):
+        for line in open('/proc/%d/status' % self.pid):
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) / 1024.0
+        return 0.0
+
+    def sample(self):
+        try:
+            self.rss.append(self.status('VmRSS'))
+            self.peak = self.status('VmHWM')
+            self.cpu_used = self.cpu() - self.cpu_start
+            self.elapsed = time.time() - self.started
+        except IOError:
+            pass
+
+def report(opts, api, server, usages, links, before_kill=None):
+    elapsed = max(u.elapsed for u in usages.values())
+    hourly = 3600.0 / elapsed
+    stats = api.stats
+    print
+    print "%d users, %d tracks, %d subscriptions, %.0fs" % (
+        opts.users, opts.tracks, links, elapsed)
+    print
+    print "API calls per hour (extrapolated):"
+    for endpoint in sorted(stats.calls):
+        print "  %-10s %10.0f  (%d errors)" % (
+            endpoint, stats.calls[endpoint] * hourly,
+            stats.errors.get(endpoint, 0))
+    print "  %-10s %10.0f" % ('total', sum(stats.calls.values()) * hourly)
+    print
+    d = server.deliveries
+    print "Deliveries: %d messages to %d users, %d statuses" % (
+        d.messages, len(d.recipients), len(d.latencies))
+    if d.latencies:
+        print "Delivery latency: p50 %.3fs  p90 %.3fs  p99 %.3fs  max %.3fs" % (
+            d.percentile(50), d.percentile(90), d.percentile(99),
+            max(d.latencies))
+    if len(usages) > 1:
+        print
+        report_workers(server, before_kill)
+    for name, usage in sorted(usages.items()):
+        print
+        if len(usages) > 1:
+            print "Worker %s:" % name
+        print "CPU: %.1fs (%.1f%% of a core)" % (
+            usage.cpu_used, 100 * usage.cpu_used / usage.elapsed)
+        if usage.rss:
+            print "RSS: %.1fMB at the end, %.1fMB peak" % (usage.rss[-1],
+                                                          usage.peak)
+
+def report_workers(server, before_kill):
+    c = server.commands
+    print "Commands: %d sent to the bare JID, %d answered, %d unanswered" % (
+        c.sent, len(c.answered), c.sent - len(c.answered))
+    answered = {}
+    for given, by, took in c.answered:
+        answered[given, by] = answered.get((given, by), 0) + 1
+    for (given, by), n in sorted(answered.items()):
+        print "  given to %-4s answered by %-4s %6d" % (given, by, n)
+    if c.answered:
+        took = sorted(t for g, b, t in c.answered)
+        print "Command latency: p50 %.3fs  max %.3fs" % (
+            took[len(took) / 2], took[-1])
+    phases = [('', server.deliveries.by_worker)]
+    if before_kill is not None:
+        phases = [(' before the kill', before_kill),
+                  (' after the kill', server.deliveries.by_worker)]
+    for when, by_worker in phases:
+        print "Users delivered to by each worker%s:" % when
+        for w, r in sorted(by_worker.items()):
+            print "  %-4s %6d" % (w, len(r))
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--users', type='int', default=1000)
+    parser.add_option('-m', '--tracks', type='int', default=500)
+    parser.add_option('--per-user', type='int', default=3,
+                      help="tracks per user")
+    parser.add_option('--private', type='float', default=0.1,
+                      help="fraction of users with twitter credentials")
+    parser.add_option('-d', '--duration', type='float', default=900)
+    parser.add_option('--latency', type='float', default=0.2,
+                      help="mean API response time in seconds")
+    parser.add_option('--error-rate', type='float', default=0.01)
+    parser.add_option('--results', type='float', default=2,
+                      help="mean new results per search")
+    parser.add_option('--max-requests', type='int', default=20000)
+    parser.add_option('--workers', type='int', default=1,
+                      help="bots sharing the account, each a shard")
+    parser.add_option('--kill-after', type='float',
+                      help="stop the last worker after this many seconds")
+    parser.add_option('--commands', type='float', default=1,
+                      help="status commands sent per second (with --workers)")
+    parser.add_option('--keep', action='store_true',
+                      help="keep the scratch directory")
+    parser.add_option('--seed', type='int', default=1)
+    opts, args = parser.parse_args()
+    random.seed(opts.seed)
+
+    domain = 'sim.example'
+    api, api_port = fakeapi.listen(latency=opts.latency,
+                                   error_rate=opts.error_rate,
+                                   results=opts.results)
+    server, xmpp_port, mc_port = fakexmpp.listen(opts.users, domain=domain)
+
+    scratch = tempfile.mkdtemp(prefix='loadsim-')
+    conf = CONF % {'dir': scratch, 'domain': domain,
+                   'api': api_port.getHost().port,
+                   'xmpp': xmpp_port.getHost().port,
+                   'memcache': mc_port.getHost().port,
+                   'max_requests': opts.max_requests}
+    open(os.path.join(scratch, 'twitterspy.conf'), 'w').write(conf)
+    open(os.path.join(scratch, 'VERSION'), 'w').write('loadsim\n')
+    os.symlink(os.path.join(TOP, 'lib'), os.path.join(scratch, 'lib'))
+    os.symlink(os.path.join(TOP, 'twitterspy.tac'),
+               os.path.join(scratch, 'twitterspy.tac'))
+    workers = {}
+    if opts.workers > 1:
+        for i in range(opts.workers):
+            name = 'w%d' % (i + 1)
+            d = workers[name] = os.path.join(scratch, name)
+            os.mkdir(d)
+            open(os.path.join(d, 'twitterspy.conf'), 'w').write(
+                conf + SHARD % name)
+            for f in ('VERSION', 'lib', 'twitterspy.tac'):
+                os.symlink(os.path.join(scratch, f), os.path.join(d, f))
+    else:
+        workers['bot'] = scratch
+
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    sys.path.insert(0, 'lib')
+    try:
+        start = time.time()
+        links = populate(opts.users, opts.tracks, opts.per_user,
+                         opts.private, domain)
+        print "Populated in %.1fs, running for %ds in %s" % (
+            time.time() - start, opts.duration, scratch)
+    finally:
+        os.chdir(cwd)
+
+    twistd = os.path.join(os.path.dirname(sys.executable), 'twistd')
+    if not os.path.exists(twistd):
+        twistd = 'twistd'
+    bots = {}
+    fleet = []
+    procs = {}
+    usages = {}
+    for name, d in sorted(workers.items()):
+        bots[name] = Bot(fleet)
+        fleet.append(bots[name])
+        procs[name] = reactor.spawnProcess(bots[name], twistd,
+            [twistd, '-n', '-y', 'twitterspy.tac', '--pidfile=',
+             '-l', 'twitterspy.log'],
+            env=os.environ, path=d)
+        usages[name] = Usage(procs[name].pid)
+    def sample():
+        for name, usage in usages.items():
+            if not bots[name].stopping:
+                usage.sample()
+    sampler = task.LoopingCall(sample)
+    sampler.start(1)
+
+    if opts.workers > 1 and opts.commands:
+        jids = server.jids()
+        def command():
+            server.command(random.choice(jids[:len(server.online)] or jids))
+        task.LoopingCall(command).start(1.0 / opts.commands, now=False)
+
+    before_kill = {}
+    def kill():
+        name = sorted(workers)[-1]
+        print "Stopping worker %s at %ds" % (name, opts.kill_after)
+        before_kill.update(server.deliveries.by_worker)
+        server.deliveries.by_worker = {}
+        bots[name].stopping = True
+        procs[name].signalProcess('TERM')
+    if opts.workers > 1 and opts.kill_after:
+        reactor.callLater(opts.kill_after, kill)
+
+    def finish():
+        sample()
+        sampler.stop()
+        for name, bot in bots.items():
+            if not bot.stopping:
+                bot.stopping = True
+                procs[name].signalProcess('TERM')
+    reactor.callLater(opts.duration, finish)
+    reactor.run()
+
+    if not all(bot.stopping for bot in bots.values()):
+        print "twitterspy exited early; see the logs in %s" % scratch
+        if not all(hasattr(u, 'elapsed') for u in usages.values()):
+            return
+        opts.keep = True
+    report(opts, api, server, usages, links, before_kill or None)
+    if opts.keep:
+        print "\nLogs and database left in", scratch
+    else:
+        shutil.rmtree(scratch)
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,76 @@
 from __future__ import with_statement
 
+import time
 import datetime
 import base64
+import threading
 
 from sqlalchemy import *
 from sqlalchemy.orm import sessionmaker, mapper, relation, backref, exc, join
+from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.exc import IntegrityError
 
 from twitterspy import config
+from twitterspy import canonical
+from twitterspy import metrics
 
-_engine = create_engine(config.CONF.get('general', 'db'))
+_engine = None
+_read_engine = None
+_engine_lock = threading.Lock()
+
+class _SQLiteTuning(PoolListener):
+    """Put each new sqlite connection in WAL mode, so readers don't block
+    the writer or each other."""
+
+    def connect(self, dbapi_con, con_record):
+        dbapi_con.execute('PRAGMA journal_mode=WAL')
+        dbapi_con.execute('PRAGMA synchronous=NORMAL')
+
+def _create_engine(url):
+    """Create an engine with the pool settings from the [db] section."""
+    kwargs = {}
+    recycle = config.getint('db', 'pool_recycle')
+    if recycle:
+        kwargs['pool_recycle'] = recycle
+    if url.startswith('sqlite'):
+        kwargs['connect_args'] = {
+            'cached_statements': config.getint('db', 'cached_statements', 100)}
+        if config.getboolean('db', 'wal'):
+            kwargs['listeners'] = [_SQLiteTuning()]
+    else:
+        for opt in ('pool_size', 'max_overflow', 'pool_timeout'):
+            v = config.getint('db', opt)
+            if v is not None:
+                kwargs[opt] = v
+    return create_engine(url, **kwargs)
+
+def engine():
+    """Get the database engine, creating it on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_engine(config.CONF.get('general', 'db'))
+    return _engine
+
+def read_engine():
+    """Get the engine for heavy reads that can stand to be a bit stale.
+
+    That's the replica in [db] read if there is one, otherwise the main
+    database."""
+    global _read_engine
+    if _read_engine is None:
+        url = config.get('db', 'read')
+        if not url:
+            return engine()
+        with _engine_lock:
+            if _read_engine is None:
+                _read_engine = _create_engine(url)
+    return _read_engine
 
 _metadata = MetaData()
 
-Session = sessionmaker()
+_Session = sessionmaker()
 
 # Adding methods to Session so it can work with a with statement
 def _session_enter(self):
@@ -21,15 +79,58 @@ def _session_enter(self):
 def _session_exit(self, *exc):
     self.close()
 
-Session.__enter__ = _session_enter
-Session.__exit__ = _session_exit
-Session.configure(bind=_engine)
+_Session.__enter__ = _session_enter
+_Session.__exit__ = _session_exit
+
+def Session():
+    return _Session(bind=engine())
+
+def ReadSession():
+    """A session on the read replica.  Don't write with it."""
+    return _Session(bind=read_engine())
+
+def _wants(make_session):
+    def decorator(orig):
+        def f(*args):
+            observed = metrics.db_seconds.time(call=orig.__name__)
+            with make_session() as session:
+                try:
+                    return orig(*args + (session,))
+                finally:
+                    observed()
+        return f
+    return decorator
+
+wants_session = _wants(Session)
+wants_read_session = _wants(ReadSession)
 
-def wants_session(orig):
-    def f(*args):
-        with Session() as session:
-            return orig(*args + (session,))
-    return f
+# Statuses of users who might be around to read a message.
+PRESENT = ('online', 'away', 'dnd', 'xa')
+
+def iter_jids(statuses=PRESENT, chunk=1000):
+    """Yield lists of the jids of users with the given statuses.
+
+    Users are read in chunks ordered by id, each picking up after the last
+    id of the previous one, so memory use stays flat however many users
+    there are and nothing is held open between chunks.  Reads go to the
+    replica if there is one."""
+    stmt = select([_users_table.c.id, _users_table.c.jid],
+                  and_(_users_table.c.status.in_(statuses),
+                       _users_table.c.id > bindparam('b_after')),
+                  order_by=[_users_table.c.id], limit=chunk)
+    after = 0
+    while True:
+        observed = metrics.db_seconds.time(call='iter_jids')
+        try:
+            rows = read_engine().execute(stmt, b_after=after).fetchall()
+        finally:
+            observed()
+        if not rows:
+            return
+        after = rows[-1][0]
+        yield [r[1] for r in rows]
+        if len(rows) < chunk:
+            return
 
 class User(object):
 
@@ -39,56 +140,128 @@ class User(object):
         if not s:
             s=Session()
         try:
-            return s.query(User).filter_by(jid=jid).one()
+            rv = s.query(User).from_statement(_user_by_jid).params(
+                b_jid=jid).all()
+            if not rv:
+                raise exc.NoResultFound("No user %s" % jid)
+            return rv[0]
         finally:
             if not session:
                 s.close()
 
+    @staticmethod
+    def set_status(jid, status, session):
+        """Set a user's status, creating the user if need be.
+
+        Nothing is loaded or committed.  Losing a race to create the user
+        only rolls back to a savepoint, so the session's other work stays."""
+        params = {'b_jid': jid, 'b_status': status or 'online'}
+        if session.execute(_set_status, params).rowcount:
+            return
+        if session.bind.name == 'sqlite':
+            # pysqlite breaks savepoints, and there's no race to lose:  the
+            # update took the database's write lock until we commit.
+            session.execute(_insert_user, {'jid': jid,
+                                           'status': params['b_status']})
+            return
+        session.begin_nested()
+        try:
+            session.execute(_insert_user, {'jid': jid,
+                                           'status': params['b_status']})
+            session.commit()
+        except IntegrityError:
+            # Someone else got there first.
+            session.rollback()
+            session.execute(_set_status, params)
+
     @staticmethod
     def update_status(jid, status, session=None):
-        """Find or create a user by jid and set the user's status"""
+        """Set a user's status, creating the user if need be, and commit.
+
+        Given a session, the user is returned as well."""
         s=session
         if not s:
             s = Session()
         try:
-            u = None
-            if not status:
-                status="online"
-            try:
-                u=User.by_jid(jid, s)
-            except exc.NoResultFound, e:
-                u=User()
-                u.jid=jid
-
-            u.status=status
-            s.add(u)
+            User.set_status(jid, status, s)
             s.commit()
-            return u
+            if session:
+                return User.by_jid(jid, s)
         finally:
             if not session:
                 s.close()
 
+    @staticmethod
+    def polling_state(jid, session):
+        """Mark a user online and get what's needed to poll for the user.
+
+        Returns ((username, password, friend timeline id, direct message id,
+        last activity), [(query, max seen)]), or None if the user is
+        inactive.  Last activity is in seconds since the epoch."""
+        User.set_status(jid, None, session)
+        row = session.execute(_user_polling, {'b_jid': jid}).fetchone()
+        active_at = row and row['active_at']
+        if row and active_at is None:
+            # Never recorded;  count idle time from now on.
+            active_at = datetime.datetime.now()
+            User.set_column(jid, 'active_at', active_at, session)
+        session.commit()
+        if not row or not row['active']:
+            return None
+        tracks = [tuple(r) for r in
+                  session.execute(_user_queries, {'b_user': row['id']})]
+        password = row['password']
+        password = base64.decodestring(password) if password else None
+        return ((row['username'], password, row['friend_timeline_id'],
+                 row['direct_message_id'],
+                 time.mktime(active_at.timetuple())), tracks)
+
+    @staticmethod
+    def set_column(jid, column, value, session):
+        """Set one column for a user, without loading the user."""
+        stmt = _user_updates.get(column)
+        if stmt is None:
+            stmt = _user_updates[column] = _users_table.update(
+                _users_table.c.jid == bindparam('b_jid'),
+                values={column: bindparam('b_value')})
+        session.execute(stmt, {'b_jid': jid, 'b_value': value})
+
+    # track and untrack write through the session's connection, so the
+    # user's tracks and user_tracks aren't updated until they're reloaded.
+
     def track(self, query, session):
-        try:
-            return session.query(Track).join(User.tracks).filter(
-                User.id == self.id).filter(Track.query == query).one()
-        except exc.NoResultFound, e:
-            try:
-                track = session.query(Track).filter_by(query=query).one()
-            except exc.NoResultFound, e:
-                track = Track()
-                track.query = query
-            self.tracks.append(track)
+        """Track a query, sharing the track with equivalent queries.
 
-    def untrack(self, query, session):
-        try:
-            t = session.query(UserTrack).select_from(
-                join(UserTrack, Track)).filter(
-                UserTrack.user_id == self.id).filter(Track.query == query).one()
-            session.delete(t)
-            return True
-        except exc.NoResultFound, e:
+        The query as the user typed it is kept as the display form.
+        Returns False, tracking nothing, if the query has nothing to
+        search for (say, only quotes or operators)."""
+        canon = canonical.canonicalize(query)
+        if canonical.is_empty(canon):
             return False
+        row = session.execute(_track_id, {'b_query': canon}).fetchone()
+        if row:
+            track_id = row[0]
+            if session.execute(_user_track_exists, {'b_user': self.id,
+                                                    'b_track': track_id}
+                               ).fetchone():
+                return True
+        else:
+            track_id = session.execute(_insert_track, {'query': canon}
+                                       ).last_inserted_ids()[0]
+        session.execute(_insert_user_track, {'user_id': self.id,
+                                             'track_id': track_id,
+                                             'display': query})
+        return True
+
+    def untrack(self, query, session):
+        return session.execute(_delete_user_track, {
+                'b_user': self.id,
+                'b_query': canonical.canonicalize(query)}).rowcount > 0
+
+    @property
+    def track_names(self):
+        """The user's tracks in the form the user entered them."""
+        return [ut.display or ut.track.query for ut in self.user_tracks]
 
     @property
     def has_credentials(self):
@@ -103,7 +276,11 @@ class User(object):
         return self.jid in config.ADMINS
 
 class Track(object):
-    pass
+
+    @staticmethod
+    def set_max_seen(query, max_seen, session):
+        session.execute(_set_max_seen, {'b_query': query,
+                                        'b_max_seen': max_seen})
 
 class UserTrack(object):
     pass
@@ -121,6 +298,7 @@ _users_table = Table('users', _metadata,
     Column('friend_timeline_id', Integer),
     Column('direct_message_id', Integer),
     Column('next_scan', DateTime),
+    Column('active_at', DateTime),
     Column('created_at', DateTime, default=datetime.datetime.now)
 )
 
@@ -134,6 +312,7 @@ _usertrack_table = Table('user_tracks', _metadata,
     Column('id', Integer, primary_key=True, index=True),
     Column('user_id', Integer, ForeignKey('users.id')),
     Column('track_id', Integer, ForeignKey('tracks.id')),
+    Column('display', String),
     Column('created_at', DateTime, default=datetime.datetime.now),
 )
 
@@ -141,7 +320,39 @@ mapper(User, _users_table, properties={
     'tracks': relation(Track, secondary=_usertrack_table, backref='tracks')
     })
 mapper(UserTrack, _usertrack_table, properties={
-    'user': relation(User),
+    'user': relation(User, backref='user_tracks'),
     'track': relation(Track)
     })
 mapper(Track, _tracks_table, properties={})
+
+# Statements for the lookups and updates done for every message, poll and
+# presence change, built once rather than as ORM queries on each call.
+_u = _users_table.c
+_t = _tracks_table.c
+_ut = _usertrack_table.c
+
+_user_by_jid = _users_table.select(_u.jid == bindparam('b_jid'))
+_set_status = _users_table.update(_u.jid == bindparam('b_jid'),
+                                  values={_u.status: bindparam('b_status')})
+_insert_user = _users_table.insert()
+_user_polling = select([_u.id, _u.active, _u.username, _u.password,
+                        _u.friend_timeline_id, _u.direct_message_id,
+                        _u.active_at],
+                       _u.jid == bindparam('b_jid'))
+_user_queries = select([_t.query, _t.max_seen],
+                       and_(_ut.track_id == _t.id,
+                            _ut.user_id == bindparam('b_user')))
+# column name -> update of that column by jid
+_user_updates = {}
+
+_track_id = select([_t.id], _t.query == bindparam('b_query'))
+_insert_track = _tracks_table.insert()
+_set_max_seen = _tracks_table.update(_t.query == bindparam('b_query'),
+    values={_t.max_seen: bindparam('b_max_seen')})
+
+_user_track_exists = select([_ut.id], and_(_ut.user_id == bindparam('b_user'),
+                                           _ut.track_id == bindparam('b_track')))
+_insert_user_track = _usertrack_table.insert()
+_delete_user_track = _usertrack_table.delete(and_(
+        _ut.user_id == bindparam('b_user'),
+        _ut.track_id.in_(select([_t.id], _t.query == bindparam('b_query')))))
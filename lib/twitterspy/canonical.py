@@ -0,0 +1,51 @@
+"""
+Canonical forms of track queries.
+
+Two queries that twitter's search would treat identically ("Python",
+" python " and '"python"') canonicalize to the same string, so they can
+share a single Query, cursor and tracks row.
+"""
+
+import re
+
+_TOKEN_RE = re.compile(r'-?"[^"]*"?|\S+')
+_SPACE_RE = re.compile(r'\s+')
+
+OR = 'OR'
+
+def tokenize(query):
+    """Split a query into terms, keeping quoted phrases together."""
+    return _TOKEN_RE.findall(query or '')
+
+def _canonical_token(tok):
+    if tok == OR:
+        return tok
+    tok = tok.lower()
+    neg = ''
+    if tok.startswith('-'):
+        neg, tok = '-', tok[1:]
+    if tok.startswith('"'):
+        phrase = _SPACE_RE.sub(' ', tok.strip('"').strip())
+        if not phrase:
+            return None
+        if ' ' in phrase:
+            tok = '"%s"' % phrase
+        else:
+            tok = phrase
+    return neg + tok
+
+def canonicalize(query):
+    """Get the canonical form of a query.
+
+    Terms are lowercased (except the OR operator), whitespace is collapsed,
+    quotes around single words are dropped and, when the query is a plain
+    conjunction of terms, the terms are sorted and deduplicated.
+    """
+    toks = [t for t in (_canonical_token(t) for t in tokenize(query)) if t]
+    if OR not in toks:
+        toks = sorted(set(toks))
+    return ' '.join(toks)
+
+def is_empty(canon):
+    """Whether a canonical query has nothing to search for, only operators."""
+    return not [t for t in tokenize(canon) if t not in (OR, '-')]
@@ -11,6 +11,44 @@ import commands
 CONF=ConfigParser.ConfigParser()
 CONF.read('twitterspy.conf')
 SCREEN_NAME = CONF.get('xmpp', 'jid')
-VERSION=commands.getoutput("git describe").strip()
+
+_version = None
+
+def version():
+    """Get the version, from the VERSION file written at build time, or git.
+
+    Either way, it's only looked up once.  An empty VERSION file counts as
+    missing."""
+    global _version
+    if _version is None:
+        try:
+            _version = open('VERSION').read().strip()
+        except IOError:
+            _version = ''
+        if not _version:
+            status, out = commands.getstatusoutput("git describe")
+            _version = out.strip() if status == 0 else 'unknown'
+    return _version
 
 ADMINS=CONF.get("general", "admins").split(' ')
+
+def get(section, option, default=None):
+    """Get an optional setting."""
+    try:
+        return CONF.get(section, option)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
+
+def getint(section, option, default=None):
+    rv = get(section, option)
+    return default if rv is None else int(rv)
+
+def getboolean(section, option, default=False):
+    rv = get(section, option)
+    if rv is None:
+        return default
+    return rv.strip().lower() in ('1', 'yes', 'true', 'on')
+
+# How tracks are fed:  'poll' (a search per track), 'stream' (the twitter
+# streaming API) or 'replay:<path>' (statuses from a local file).
+INGEST=get('general', 'ingest', 'poll')
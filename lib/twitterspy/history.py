@@ -0,0 +1,225 @@
+"""
+An archive of delivered track results, for the history command.
+
+Results are appended to one log file per (UTC) day in the history
+directory, as marshalled (query, eid, time, plain, html) records.  An index
+in memory maps each canonical query to the (eid, time, segment, offset) of
+its most recent results, and is rebuilt by scanning the segments at
+startup (keeping only the latest per_query offsets for each query as it
+goes, so memory doesn't grow with the size of the archive).  Appends are
+buffered and written from a thread every few seconds.
+
+Compaction deletes whole segments:  those older than the retention period,
+then the oldest while the archive is over its size limit.
+"""
+
+import os
+import time
+import bisect
+import marshal
+
+from twisted.python import log
+from twisted.internet import threads
+
+import config
+import canonical
+
+SUFFIX = '.log'
+
+def _segment(t):
+    return time.strftime('%Y%m%d', time.gmtime(t))
+
+class Archive(object):
+
+    def __init__(self, path, days=7, max_bytes=512 << 20, per_query=100):
+        self.path = path
+        self.days = days
+        self.max_bytes = max_bytes
+        self.per_query = per_query
+        # canonical query -> [(eid, time, segment, offset)], oldest first
+        self.index = {}
+        self.pending = []
+        self.flushing = False
+
+    def _segments(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(f[:-len(SUFFIX)] for f in os.listdir(self.path)
+                      if f.endswith(SUFFIX))
+
+    def _file(self, segment):
+        return os.path.join(self.path, segment + SUFFIX)
+
+    def _index(self, entries):
+        n = 0
+        for q, eid, t, segment, offset in entries:
+            n += 1
+            l = self.index.get(q)
+            if l is None:
+                l = self.index[q] = []
+            entry = (eid, t, segment, offset)
+            if not l or eid > l[-1][0]:
+                l.append(entry)
+            else:
+                # Only while loading races with the first flushes.
+                i = bisect.bisect_left(l, (eid,))
+                if i < len(l) and l[i][0] == eid:
+                    continue
+                l.insert(i, entry)
+            # Trimmed in bulk, so this is cheap on average.
+            if len(l) > 2 * self.per_query:
+                del l[:-self.per_query]
+        return n
+
+    def _scan(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+            return {}
+        # canonical query -> [(eid, time, segment, offset)], oldest first
+        found = {}
+        per_query = self.per_query
+        for segment in self._segments():
+            f = open(self._file(segment), 'rb')
+            try:
+                while True:
+                    offset = f.tell()
+                    try:
+                        q, eid, t, plain, html = marshal.load(f)
+                    except (EOFError, ValueError, TypeError):
+                        # The end, or a record cut short by a crash.
+                        break
+                    l = found.get(q)
+                    if l is None:
+                        l = found[q] = []
+                    l.append((eid, t, segment, offset))
+                    if len(l) > 2 * per_query:
+                        del l[:-per_query]
+            finally:
+                f.close()
+        return found
+
+    def load(self):
+        """Rebuild the index from the segments on disk.
+
+        Creates the history directory if need be."""
+        def loaded(found):
+            n = self._index((q, eid, t, segment, offset)
+                            for q, l in found.iteritems()
+                            for eid, t, segment, offset in sorted(l))
+            log.msg("Loaded %d archived results for %d queries"
+                    % (n, len(self.index)))
+        return threads.deferToThread(self._scan).addCallback(
+            loaded).addErrback(log.err)
+
+    def append(self, query, results):
+        """Archive delivered (eid, plain, html) results for a query."""
+        now = int(time.time())
+        for eid, plain, html in results:
+            self.pending.append((query, eid, now, plain, html))
+
+    def _write(self, records):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        written = []
+        files = {}
+        try:
+            for r in records:
+                segment = _segment(r[2])
+                f = files.get(segment)
+                if f is None:
+                    f = files[segment] = open(self._file(segment), 'ab')
+                    f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                marshal.dump(r, f)
+                written.append((r[0], r[1], r[2], segment, offset))
+        finally:
+            for f in files.values():
+                f.close()
+        return written
+
+    def flush(self):
+        """Write out buffered results.  Returns a Deferred, or None."""
+        if self.flushing or not self.pending:
+            return None
+        records, self.pending = self.pending, []
+        self.flushing = True
+        def done(x):
+            self.flushing = False
+            return x
+        return threads.deferToThread(self._write, records).addCallback(
+            self._index).addBoth(done).addErrback(log.err)
+
+    def _read(self, entries):
+        rv = []
+        files = {}
+        try:
+            for eid, t, segment, offset in entries:
+                try:
+                    f = files.get(segment)
+                    if f is None:
+                        f = files[segment] = open(self._file(segment), 'rb')
+                    f.seek(offset)
+                    q, eid, t, plain, html = marshal.load(f)
+                except (IOError, EOFError, ValueError):
+                    # Compacted away since we looked.
+                    continue
+                rv.append((eid, t, plain, html))
+        finally:
+            for f in files.values():
+                f.close()
+        return rv
+
+    def lookup(self, query, limit=10, since=None):
+        """Get the latest archived results for a query.
+
+        Returns a Deferred list of up to limit (eid, time, plain, html),
+        oldest first, optionally only those archived since the given
+        time."""
+        key = canonical.canonicalize(query)
+        entries = self.index.get(key, [])
+        if since:
+            entries = [e for e in entries if e[1] >= since]
+        unwritten = [(eid, t, plain, html)
+                     for q, eid, t, plain, html in self.pending
+                     if q == key and (not since or t >= since)]
+        entries = entries[-limit:]
+        def read(rv):
+            return (rv + unwritten)[-limit:]
+        return threads.deferToThread(self._read, entries).addCallback(read)
+
+    def _compact(self, now):
+        cutoff = _segment(now - self.days * 86400)
+        segments = self._segments()
+        sizes = dict((s, os.path.getsize(self._file(s))) for s in segments)
+        total = sum(sizes.values())
+        removed = []
+        for s in segments:
+            # Never the newest, that's the one being written.
+            if s == segments[-1]:
+                break
+            if s >= cutoff and total <= self.max_bytes:
+                break
+            os.unlink(self._file(s))
+            total -= sizes[s]
+            removed.append(s)
+        return removed
+
+    def compact(self):
+        """Drop segments past retention or over the size limit."""
+        def compacted(removed):
+            if not removed:
+                return
+            gone = set(removed)
+            for q, l in self.index.items():
+                l[:] = [e for e in l if e[2] not in gone]
+                if not l:
+                    del self.index[q]
+            log.msg("Compacted the history, removing %s" % ', '.join(removed))
+        return threads.deferToThread(self._compact, time.time()).addCallback(
+            compacted).addErrback(log.err)
+
+archive = None
+if config.get('general', 'history'):
+    archive = Archive(config.get('general', 'history'),
+                      config.getint('general', 'history_days', 7),
+                      config.getint('general', 'history_max_mb', 512) << 20)
@@ -0,0 +1,148 @@
+"""
+Concurrency limits that put the most important work first and size
+themselves to how the far end is coping.
+
+A Limiter is used like a DeferredSemaphore, but waiting calls are started
+highest priority first (first come first served among equals), and the
+number allowed at once moves between a floor and a ceiling:  it creeps up
+while calls are queueing and finishing about as fast as they ever do, and
+is cut back when they slow down well past that or fail.
+
+Calls answered without going to the far end (a cache hit, or failing
+because we're out of requests) say nothing about how it's coping, so
+their Deferreds can be marked with local() to keep them out of the
+figures.
+"""
+
+import heapq
+import itertools
+import collections
+
+from twisted.python import log
+from twisted.internet import defer, reactor
+
+def local(d):
+    """Mark a Deferred as answered locally.  Returns the Deferred."""
+    d.limiter_local = True
+    return d
+
+def is_local(d):
+    return getattr(d, 'limiter_local', False)
+
+class _Prioritized(object):
+
+    def __init__(self, limiter, priority):
+        self.limiter = limiter
+        self.priority = priority
+
+    def run(self, f, *args, **kwargs):
+        return self.limiter.run_prioritized(self.priority, f, *args, **kwargs)
+
+class Limiter(object):
+
+    # Cut back once calls take this many times their usual time, and at
+    # least this many seconds longer.
+    slow = 2.0
+    slow_by = 0.1
+    # Look at the limit every this many completed calls.
+    adjust_every = 10
+    # Cut back if more than this fraction of those failed.
+    max_failures = 0.2
+    # Weight of the latest call in the running average.
+    smoothing = 0.2
+    # The usual time is this fraction of the way up the times of the last
+    # so many calls.
+    usual_percentile = 0.1
+    usual_window = 100
+
+    def __init__(self, name, limit, minimum=1, maximum=None):
+        self.name = name
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum or limit * 4
+        self.running = 0
+        self.waiting = []
+        self.seq = itertools.count()
+        # Running average of call times, and the recent times that the
+        # usual time is taken from.
+        self.latency = None
+        self.baseline = None
+        self.recent = collections.deque(maxlen=self.usual_window)
+        self.completed = 0
+        self.failures = 0
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def prioritized(self, priority):
+        """Get something to run() calls at the given priority with."""
+        return _Prioritized(self, priority)
+
+    def run(self, f, *args, **kwargs):
+        return self.run_prioritized(0, f, *args, **kwargs)
+
+    def run_prioritized(self, priority, f, *args, **kwargs):
+        """Run f when there's room, higher priorities first.
+
+        Returns a Deferred firing with f's result."""
+        d = defer.Deferred()
+        heapq.heappush(self.waiting,
+                       (-priority, self.seq.next(), d, f, args, kwargs))
+        self._start()
+        return d
+
+    def _start(self):
+        while self.waiting and self.running < self.limit:
+            p, seq, d, f, args, kwargs = heapq.heappop(self.waiting)
+            self.running += 1
+            started = reactor.seconds()
+            r = defer.maybeDeferred(f, *args, **kwargs)
+            counted = not is_local(r)
+            r.addCallbacks(self._succeeded, self._failed,
+                           callbackArgs=(started, counted),
+                           errbackArgs=(started, counted))
+            r.chainDeferred(d)
+
+    def _succeeded(self, x, started, counted):
+        self._done(reactor.seconds() - started, False, counted)
+        return x
+
+    def _failed(self, e, started, counted):
+        self._done(reactor.seconds() - started, True, counted)
+        return e
+
+    def _done(self, elapsed, failed, counted=True):
+        self.running -= 1
+        if not counted:
+            self._start()
+            return
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += (elapsed - self.latency) * self.smoothing
+        self.recent.append(elapsed)
+        if failed:
+            self.failures += 1
+        self.completed += 1
+        if self.completed % self.adjust_every == 0:
+            self._adjust()
+        self._start()
+
+    def _adjust(self):
+        old = self.limit
+        # A low percentile rather than the fastest call, so the odd
+        # instant answer doesn't make every other call look slow.
+        times = sorted(self.recent)
+        self.baseline = times[int(len(times) * self.usual_percentile)]
+        if (self.failures > self.max_failures * self.adjust_every
+            or self.latency > max(self.baseline * self.slow,
+                                  self.baseline + self.slow_by)):
+            self.limit = max(self.minimum, int(self.limit * 0.75))
+        elif self.waiting:
+            self.limit = min(self.maximum, self.limit + 1)
+        self.failures = 0
+        if self.limit != old:
+            log.msg("%s concurrency %d -> %d (latency %.2fs, usually %.2fs,"
+                    " %d waiting)" % (self.name, old, self.limit,
+                                      self.latency, self.baseline,
+                                      len(self.waiting)))
@@ -0,0 +1,203 @@
+"""
+Local matching of statuses against many track queries at once.
+
+All the words and phrases of all queries are compiled into a single
+Aho-Corasick automaton over word tokens, so matching a status costs time
+proportional to the length of the status and the number of hits, not the
+number of queries.
+"""
+
+import re
+
+import canonical
+
+_WORD_RE = re.compile(r'([#@]?)(\w+)', re.UNICODE)
+# A word as it may appear in a query term we can match.
+_TERM_WORD_RE = re.compile(r'[#@]?\w+$', re.UNICODE)
+
+# Operators we can evaluate locally.  Queries using any other operator
+# (since:, lang:, filter:, ...) are left to the search API.
+_FROM = 'from:'
+
+# Expanding OR groups is exponential, don't bother past this many clauses.
+MAX_CLAUSES = 32
+
+def words(text):
+    """The words of some text, any # or @ dropped.
+
+    Search matches a word whether or not it's a hashtag or mention, so
+    "python" finds "#python"."""
+    return [w for p, w in _WORD_RE.findall(text.lower())]
+
+def tags(text):
+    """The hashtags and mentions in some text, with their # or @."""
+    return [p + w for p, w in _WORD_RE.findall(text.lower()) if p]
+
+class Unmatchable(ValueError):
+    """The query can't be evaluated locally."""
+
+def _term(tok, query):
+    """Get the words of a query term.
+
+    A term with anything the tokenizer would drop ("c++", "e-mail") can't be
+    matched on words alone, and nor can a phrase with a hashtag or mention
+    in it.  A lone hashtag or mention is kept as a single tagged word."""
+    ws = tok.strip('"').lower().split()
+    for w in ws:
+        if not _TERM_WORD_RE.match(w):
+            raise Unmatchable(query)
+    if len(ws) > 1 and [w for w in ws if w[0] in '#@']:
+        raise Unmatchable(query)
+    return tuple(ws)
+
+def compile_query(query):
+    """Compile a canonical query into clauses.
+
+    Each clause is a (required, excluded) pair of term tuples, where a term
+    is a tuple of words.  A status matches the query if it matches any
+    clause.
+    """
+    groups = []
+    toks = canonical.tokenize(query)
+    i = 0
+    while i < len(toks):
+        if toks[i] == canonical.OR:
+            i += 1
+            continue
+        group = [toks[i]]
+        while i + 2 < len(toks) and toks[i + 1] == canonical.OR:
+            group.append(toks[i + 2])
+            i += 2
+        groups.append(group)
+        i += 1
+
+    clauses = [((), ())]
+    for group in groups:
+        expanded = []
+        for tok in group:
+            neg = tok.startswith('-') and len(tok) > 1
+            if neg:
+                tok = tok[1:]
+            if tok.lower().startswith(_FROM):
+                term = (tok.lower(),)
+            elif ':' in tok.strip('"') and not tok.startswith('"'):
+                raise Unmatchable(query)
+            else:
+                term = _term(tok, query)
+            if not term:
+                continue
+            for req, exc in clauses:
+                if neg:
+                    expanded.append((req, exc + (term,)))
+                else:
+                    expanded.append((req + (term,), exc))
+        if expanded:
+            clauses = expanded
+        if len(clauses) > MAX_CLAUSES:
+            raise Unmatchable(query)
+    if not [c for c in clauses if c[0]]:
+        raise Unmatchable(query)
+    return clauses
+
+class Matcher(object):
+    """Match statuses against a fixed set of canonical queries."""
+
+    def __init__(self, queries=()):
+        # Trie over words: goto[node] is a dict of word -> node.
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        self.term_ids = {}
+        # term id -> [clause id]; clause id -> (query, n required, excluded)
+        self.requiring = []
+        self.clauses = []
+        self.unmatchable = set()
+
+        for q in queries:
+            try:
+                compiled = compile_query(q)
+            except Unmatchable:
+                self.unmatchable.add(q)
+                continue
+            for req, exc in compiled:
+                cid = len(self.clauses)
+                req = set(self._term(t) for t in req)
+                self.clauses.append(
+                    (q, len(req), frozenset(self._term(t) for t in exc)))
+                for tid in req:
+                    self.requiring[tid].append(cid)
+        self._build_failures()
+
+    def __len__(self):
+        return len(set(c[0] for c in self.clauses))
+
+    def covers(self, query):
+        return query not in self.unmatchable
+
+    def _term(self, term):
+        tid = self.term_ids.get(term)
+        if tid is None:
+            tid = self.term_ids[term] = len(self.requiring)
+            self.requiring.append([])
+            node = 0
+            for w in term:
+                nxt = self.goto[node].get(w)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][w] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                node = nxt
+            self.out[node] = self.out[node] + (tid,)
+        return tid
+
+    def _build_failures(self):
+        queue = list(self.goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for w, child in self.goto[node].iteritems():
+                queue.append(child)
+                f = self.fail[node]
+                while f and w not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(w, 0)
+                self.fail[child] = target if target != child else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def terms_in(self, text, author=None):
+        """Find the ids of all terms occurring in the given text."""
+        found = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for w in words(text):
+            while node and w not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(w, 0)
+            if out[node]:
+                found.update(out[node])
+        for t in tags(text):
+            tid = self.term_ids.get((t,))
+            if tid is not None:
+                found.add(tid)
+        if author:
+            tid = self.term_ids.get((_FROM + author.lower(),))
+            if tid is not None:
+                found.add(tid)
+        return found
+
+    def match(self, text, author=None):
+        """Get the set of queries matching the given status text."""
+        found = self.terms_in(text, author)
+        counts = {}
+        for tid in found:
+            for cid in self.requiring[tid]:
+                counts[cid] = counts.get(cid, 0) + 1
+        rv = set()
+        for cid, n in counts.iteritems():
+            q, needed, excluded = self.clauses[cid]
+            if n == needed and not (excluded and excluded & found):
+                rv.add(q)
+        return rv
@@ -0,0 +1,216 @@
+"""
+Counters, gauges and histograms for watching twitterspy run.
+
+Everything registered here is available in the Prometheus text format
+(over HTTP when metrics_port is configured) and summarized by the
+adm_stats command.
+"""
+
+import time
+import bisect
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def _labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in items)
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def samples(self):
+        """Yield (name suffix, label key, extra labels, value) samples."""
+        for key, v in sorted(self.values.items()):
+            yield '', key, (), v
+
+    def render(self):
+        rv = ['# HELP %s %s' % (self.name, self.help),
+              '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, key, extra, v in self.samples():
+            rv.append('%s%s%s %s' % (self.name, suffix, _labels(key, extra),
+                                     repr(float(v))))
+        return rv
+
+    def summary(self):
+        return ['%s%s %s' % (self.name, _labels(k), v)
+                for k, v in sorted(self.values.items())]
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        k = _key(labels)
+        self.values[k] = self.values.get(k, 0) + n
+
+    def total(self):
+        return sum(self.values.values())
+
+class Gauge(Metric):
+    """A value that's set, or read from a function when exported."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, f=None):
+        super(Gauge, self).__init__(name, help)
+        self.f = f
+
+    def set(self, v, **labels):
+        self.values[_key(labels)] = v
+
+    def samples(self):
+        if self.f:
+            self.values[()] = self.f()
+        return super(Gauge, self).samples()
+
+    def summary(self):
+        if self.f:
+            self.values[()] = self.f()
+        return super(Gauge, self).summary()
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, v, **labels):
+        k = _key(labels)
+        h = self.values.get(k)
+        if h is None:
+            # bucket counts, count, sum, max
+            h = self.values[k] = [[0] * len(self.buckets), 0, 0.0, 0.0]
+        i = bisect.bisect_left(self.buckets, v)
+        if i < len(self.buckets):
+            h[0][i] += 1
+        h[1] += 1
+        h[2] += v
+        h[3] = max(h[3], v)
+
+    def time(self, **labels):
+        """Get a function that observes the time since now when called.
+
+        The function passes its argument through, so it can be a callback."""
+        start = time.time()
+        def f(x=None):
+            self.observe(time.time() - start, **labels)
+            return x
+        return f
+
+    def samples(self):
+        for key, (counts, n, total, mx) in sorted(self.values.items()):
+            cumulative = 0
+            for le, c in zip(self.buckets, counts):
+                cumulative += c
+                yield '_bucket', key, (('le', le),), cumulative
+            yield '_bucket', key, (('le', '+Inf'),), n
+            yield '_count', key, (), n
+            yield '_sum', key, (), total
+
+    def summary(self):
+        return ['%s%s n=%d avg=%.3f max=%.3f'
+                % (self.name, _labels(k), n, total / max(n, 1), mx)
+                for k, (counts, n, total, mx) in sorted(self.values.items())]
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, m):
+        self.metrics.append(m)
+        return m
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help, f=None):
+        return self._add(Gauge(name, help, f))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        rv = []
+        for m in self.metrics:
+            rv.extend(m.render())
+        return '\n'.join(rv) + '\n'
+
+    def summary(self):
+        rv = []
+        for m in self.metrics:
+            rv.extend(m.summary())
+        return rv
+
+registry = Registry()
+
+api_calls = registry.counter('twitterspy_api_calls_total',
+                             'Twitter API calls made, by endpoint.')
+search_seconds = registry.histogram('twitterspy_search_seconds',
+                                    'Time taken by track searches.')
+search_results = registry.histogram('twitterspy_search_results',
+                                    'Results per track search.',
+                                    COUNT_BUCKETS)
+dedup = registry.counter('twitterspy_dedup_total',
+                         'Deliveries checked against memcached, by result.')
+messages_sent = registry.counter('twitterspy_messages_sent_total',
+                                 'Stanzas written to the XMPP stream.')
+semaphore_wait = registry.histogram('twitterspy_semaphore_wait_seconds',
+                                    'Time spent waiting for a semaphore.')
+db_seconds = registry.histogram('twitterspy_db_seconds',
+                                'Time taken by database calls.')
+reactor_lag = registry.histogram('twitterspy_reactor_lag_seconds',
+                                 'How late a periodic reactor timer fires.')
+
+def run_timed(sem, name, f, *args, **kwargs):
+    """Run f under a semaphore or limiter, recording how long it waited."""
+    observed = semaphore_wait.time(semaphore=name)
+    def g(*a, **kw):
+        observed()
+        return f(*a, **kw)
+    return sem.run(g, *args, **kwargs)
+
+class LagMonitor(object):
+    """Call every interval seconds to record reactor lag."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = None
+
+    def __call__(self):
+        now = time.time()
+        if self.last is not None:
+            reactor_lag.observe(max(0, now - self.last - self.interval))
+        self.last = now
+
+def listen(port):
+    """Get a service exporting the metrics over HTTP on localhost."""
+    from twisted.application import internet
+    from twisted.web import resource, server
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+            return registry.render()
+
+    return internet.TCPServer(port, server.Site(MetricsResource()),
+                              interface='127.0.0.1')
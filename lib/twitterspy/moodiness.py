@@ -1,11 +1,70 @@
 from collections import deque
+import time
 import random
 
 from twisted.python import log
+from twisted.internet import defer, error
+from twisted.web import error as web_error
 
 import protocol
+import metrics
 
-MAX_RESULTS = 1000
+# Outcomes are remembered for WINDOW seconds, counted in BUCKET second slots.
+WINDOW = 600
+BUCKET = 10
+
+OK = 'ok'
+RATE_LIMIT = 'rate_limit'
+TIMEOUT = 'timeout'
+SERVER_ERROR = 'server_error'
+OTHER = 'other'
+
+api_results = metrics.registry.counter('twitterspy_api_results_total',
+    'Outcomes of twitter API calls, by endpoint and outcome.')
+
+def classify(failure):
+    """Work out what kind of error a failed API call hit."""
+    if failure.check(web_error.Error):
+        status = str(failure.value.status)
+        if status in ('400', '420', '429'):
+            return RATE_LIMIT
+        if status.startswith('5'):
+            return SERVER_ERROR
+    elif failure.check(defer.TimeoutError, error.TimeoutError,
+                       error.TCPTimedOutError):
+        return TIMEOUT
+    return OTHER
+
+class Window(object):
+    """Running counts of outcomes over the last WINDOW seconds."""
+
+    def __init__(self):
+        self.buckets = deque()
+        self.totals = {}
+        self.total = 0
+
+    def _expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - WINDOW:
+            start, counts = self.buckets.popleft()
+            for k, n in counts.iteritems():
+                self.totals[k] -= n
+                self.total -= n
+
+    def add(self, outcome, now=None):
+        now = now or time.time()
+        self._expire(now)
+        start = now - now % BUCKET
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append((start, {}))
+        counts = self.buckets[-1][1]
+        counts[outcome] = counts.get(outcome, 0) + 1
+        self.totals[outcome] = self.totals.get(outcome, 0) + 1
+        self.total += 1
+
+    def counts(self, now=None):
+        """Get (outcome counts, total) for the window."""
+        self._expire(now or time.time())
+        return self.totals, self.total
 
 class Moodiness(object):
 
@@ -17,17 +76,40 @@ class Moodiness(object):
         ]
 
     def __init__(self):
-        self.recent_results = deque()
+        self.windows = {}
         self.previous_good = (0, 0)
 
+    def window(self, endpoint):
+        w = self.windows.get(endpoint)
+        if w is None:
+            w = self.windows[endpoint] = Window()
+        return w
+
+    def record(self, endpoint, outcome):
+        self.window(endpoint).add(outcome)
+        api_results.inc(endpoint=endpoint, outcome=outcome)
+
+    def success_rate(self, endpoint='search'):
+        """Get (good, total, fraction good) of recent calls to an endpoint."""
+        counts, total = self.window(endpoint).counts()
+        good = counts.get(OK, 0)
+        return good, total, float(good) / total if total else None
+
+    def error_rate(self, endpoint, outcome):
+        counts, total = self.window(endpoint).counts()
+        return float(counts.get(outcome, 0)) / total if total else 0.0
+
+    def throttled(self, endpoint, minimum=10):
+        """Have most recent calls to this endpoint been rate limited?"""
+        counts, total = self.window(endpoint).counts()
+        return total >= minimum and counts.get(RATE_LIMIT, 0) * 2 > total
+
     def current_mood(self):
         """Get the current mood (good, total, percentage)"""
-        if not self.recent_results:
+        good, total, percentage = self.success_rate('search')
+        if not total:
             log.msg("Short-circuiting tally results since there aren't any.")
             return None, None, None, None
-        good = reduce(lambda x, y: x + 1 if y else x, self.recent_results)
-        total = len(self.recent_results)
-        percentage = float(good) / float(total)
         choices=[v for a,v in self.MOOD_CHOICES if percentage >= a][0]
         mood=random.choice(choices)
 
@@ -37,28 +119,41 @@ class Moodiness(object):
         mood, good, total, percentage = self.current_mood()
         if mood is None:
             return
-        self.previous_good = (good, total)
 
         msg = ("Processed %d out of %d recent searches (previously %d/%d)."
             % (good, total, self.previous_good[0], self.previous_good[1]))
+        self.previous_good = (good, total)
 
         log.msg(msg + " my mood is " + mood)
         conn = protocol.current_conn
         if conn:
             conn.publish_mood(mood, msg)
 
-    def add(self, result):
-        if len(self.recent_results) >= MAX_RESULTS:
-            self.recent_results.popleft()
-        self.recent_results.append(result)
+    def success(self, endpoint):
+        """Get a callback recording a successful call to the endpoint."""
+        def f(x):
+            self.record(endpoint, OK)
+            return x
+        return f
+
+    def failure(self, endpoint):
+        """Get an errback recording a failed call to the endpoint."""
+        def f(e):
+            self.record(endpoint, classify(e))
+            return e
+        return f
 
     def markSuccess(self, *args):
         """Record that a search was successfully performed."""
-        self.add(True)
+        self.record('search', OK)
 
     def markFailure(self, error):
         """Record that a search failed to complete successfully."""
-        self.add(False)
+        self.record('search', classify(error))
         return error
 
 moodiness = Moodiness()
+
+metrics.registry.gauge('twitterspy_search_success_ratio',
+                       'Fraction of recent searches that worked.',
+                       lambda: moodiness.success_rate('search')[2] or 0.0)
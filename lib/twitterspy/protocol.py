@@ -3,9 +3,13 @@
 from __future__ import with_statement
 
 import time
+from collections import deque
+
+from zope.interface import implements
 
 from twisted.python import log
-from twisted.internet import protocol, reactor
+from twisted.internet import protocol, reactor, defer, task, error
+from twisted.internet.interfaces import IPushProducer
 from twisted.words.xish import domish
 from twisted.words.protocols.jabber.jid import JID
 from twisted.words.protocols.jabber.xmlstream import IQ
@@ -18,12 +22,36 @@ import xmpp_commands
 import config
 import models
 import scheduling
+import sharding
+import metrics
+import slog
 import string
 
+delivery_log = slog.category('delivery')
+presence_log = slog.category('presence')
+
 current_conn = None
 presence_conn = None
 mc = None
 
+# Users getting more new results than this at once get them as a digest.
+# Zero disables digests.
+DIGEST_THRESHOLD = config.getint('general', 'digest_threshold', 0)
+
+MEMCACHE_HOST, _port = (config.get('general', 'memcache', 'localhost')
+                        + ':%d' % memcache.DEFAULT_PORT).split(':')[:2]
+MEMCACHE_PORT = int(_port)
+
+def _outq_stat(attr):
+    return lambda: getattr(current_conn.outq, attr) if current_conn else 0
+
+metrics.registry.gauge('twitterspy_outq_depth',
+                       'Stanzas waiting in the outbound queue.',
+                       _outq_stat('depth'))
+metrics.registry.gauge('twitterspy_outq_drain_rate',
+                       'Stanzas per second written from the outbound queue.',
+                       _outq_stat('drain_rate'))
+
 class MemcacheFactory(protocol.ReconnectingClientFactory):
 
     def buildProtocol(self, addr):
@@ -33,6 +61,193 @@ class MemcacheFactory(protocol.ReconnectingClientFactory):
         mc = memcache.MemCacheProtocol()
         return mc
 
+class OutboundQueue(object):
+    """Chat messages waiting to be written to the stream.
+
+    Stanzas are written in batches.  The queue is registered as a producer
+    on the transport, so it stops writing while the transport's buffer is
+    full, and producers of bulk messages can wait() for it to drain.  Each
+    recipient is limited to a steady rate of messages so servers don't
+    throttle us.
+
+    Messages held back for a recipient who goes offline are dropped, and
+    everything queued is dropped (and waiting producers failed) when the
+    stream goes away."""
+
+    implements(IPushProducer)
+
+    # Stanzas written to the stream at once.
+    flush_size = 50
+    # Producers are asked to wait above this many queued stanzas.
+    high_water = 1000
+    # Messages per second (and burst) for a single recipient.
+    recipient_rate = 1.0
+    recipient_burst = 10
+
+    def __init__(self, send):
+        self.send = send
+        self.ready = deque()
+        # bare jid -> deque of messages over its rate
+        self.held = {}
+        # bare jid -> [tokens, as of]
+        self.buckets = {}
+        # (as of, bare jid) of each bucket update, oldest first
+        self.touched = deque()
+        self.depth = 0
+        self.paused = False
+        self.stopped = False
+        self.waiters = []
+        self.sent = 0
+        self.drain_rate = 0.0
+        self._last_sent = 0
+        self._drain_call = None
+        self._held_call = None
+        self._rate_loop = task.LoopingCall(self._update_rate)
+        self._rate_loop.start(1, now=False)
+
+    @property
+    def full(self):
+        return self.paused or self.depth >= self.high_water
+
+    def attach(self, transport):
+        self.paused = False
+        self.stopped = False
+        transport.registerProducer(self, True)
+        self._schedule_drain()
+
+    def put(self, jid, msg, paced=True):
+        """Queue a message, held back if its recipient is over the rate.
+
+        Messages to our own peers aren't paced;  they all share one bare
+        JID."""
+        self.depth += 1
+        if not paced:
+            self.ready.append(msg)
+            self._schedule_drain()
+            return
+        bare = jid.split('/', 1)[0]
+        q = self.held.get(bare)
+        if q is None and self._take(bare):
+            self.ready.append(msg)
+            self._schedule_drain()
+        else:
+            if q is None:
+                q = self.held[bare] = deque()
+            q.append(msg)
+            self._schedule_held()
+
+    def wait(self):
+        """Get a Deferred that fires when there's room in the queue."""
+        d = defer.Deferred()
+        if self.stopped:
+            d.errback(error.ConnectionLost("Not connected."))
+        elif self.full:
+            self.waiters.append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def discard(self, bare):
+        """Drop any messages held back for a recipient."""
+        q = self.held.pop(bare, None)
+        if q:
+            delivery_log.debug("Dropping %d held messages for %s",
+                               len(q), bare)
+            self.depth -= len(q)
+            self._wake_waiters()
+
+    def _forget(self, now):
+        """Forget recipients whose buckets have refilled since."""
+        refilled = now - self.recipient_burst / self.recipient_rate
+        touched = self.touched
+        while touched and touched[0][0] < refilled:
+            t, bare = touched.popleft()
+            b = self.buckets.get(bare)
+            # Otherwise it's been used since, and is further back in line.
+            if b is not None and b[1] == t and bare not in self.held:
+                del self.buckets[bare]
+
+    def _take(self, bare):
+        now = time.time()
+        self._forget(now)
+        b = self.buckets.get(bare)
+        if b is None:
+            tokens = self.recipient_burst
+        else:
+            tokens = min(self.recipient_burst,
+                         b[0] + (now - b[1]) * self.recipient_rate)
+        self.touched.append((now, bare))
+        if tokens >= 1:
+            self.buckets[bare] = [tokens - 1, now]
+            return True
+        self.buckets[bare] = [tokens, now]
+        return False
+
+    def _schedule_drain(self):
+        if not self._drain_call and not self.paused:
+            self._drain_call = reactor.callLater(0, self._drain)
+
+    def _schedule_held(self):
+        if not self._held_call:
+            self._held_call = reactor.callLater(1.0 / self.recipient_rate,
+                                                self._release_held)
+
+    def _release_held(self):
+        self._held_call = None
+        for bare in list(self.held):
+            q = self.held[bare]
+            while q and self._take(bare):
+                self.ready.append(q.popleft())
+            if not q:
+                del self.held[bare]
+        if self.held:
+            self._schedule_held()
+        self._schedule_drain()
+
+    def _drain(self):
+        self._drain_call = None
+        while self.ready and not self.paused:
+            batch = [self.ready.popleft()
+                     for i in range(min(self.flush_size, len(self.ready)))]
+            self.depth -= len(batch)
+            self.sent += len(batch)
+            metrics.messages_sent.inc(len(batch))
+            self.send(u"".join(m.toXml() for m in batch))
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        if not self.full:
+            waiters, self.waiters = self.waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def _update_rate(self):
+        sent = self.sent - self._last_sent
+        self._last_sent = self.sent
+        self.drain_rate = 0.8 * self.drain_rate + 0.2 * sent
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._schedule_drain()
+
+    def stopProducing(self):
+        self.paused = True
+        self.stopped = True
+        dropped = self.depth
+        self.ready.clear()
+        self.held.clear()
+        self.buckets.clear()
+        self.touched.clear()
+        self.depth = 0
+        if dropped:
+            log.msg("Dropped %d queued stanzas with the stream" % dropped)
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.errback(error.ConnectionLost("The stream went away."))
+
 class TwitterspyMessageProtocol(MessageProtocol):
 
     def __init__(self):
@@ -43,6 +258,8 @@ class TwitterspyMessageProtocol(MessageProtocol):
         goodChars=string.letters + string.digits + "/=,_+.-~@"
         self.jidtrans = self._buildGoodSet(goodChars)
 
+        self.outq = OutboundQueue(self.send)
+
     def _buildGoodSet(self, goodChars, badChar='_'):
         allChars=string.maketrans("", "")
         badchars=string.translate(allChars, allChars, goodChars)
@@ -52,14 +269,6 @@ class TwitterspyMessageProtocol(MessageProtocol):
     def connectionMade(self):
         log.msg("Connected!")
 
-        commands=xmpp_commands.all_commands
-        self.commands={}
-        for c in commands.values():
-            self.commands[c.name] = c
-            for a in c.aliases:
-                self.commands[a] = c
-        log.msg("Loaded commands: %s" % `sorted(commands.keys())`)
-
         # Let the scheduler know we connected.
         scheduling.connected()
 
@@ -68,9 +277,12 @@ class TwitterspyMessageProtocol(MessageProtocol):
         global current_conn
         current_conn = self
 
+    def connectionInitialized(self):
+        super(TwitterspyMessageProtocol, self).connectionInitialized()
+        self.outq.attach(self.xmlstream.transport)
+
     def __connectMemcached(self):
-        reactor.connectTCP('localhost', memcache.DEFAULT_PORT,
-            MemcacheFactory())
+        reactor.connectTCP(MEMCACHE_HOST, MEMCACHE_PORT, MemcacheFactory())
 
     def connectionLost(self, reason):
         log.msg("Disconnected!")
@@ -117,7 +329,17 @@ class TwitterspyMessageProtocol(MessageProtocol):
         msg["type"] = 'chat'
         msg.addElement("body", content=content)
 
-        self.send(msg)
+        self.outq.put(jid, msg)
+
+    def send_peer(self, jid, content):
+        """Send to another worker, without the per-recipient pacing."""
+        msg = domish.Element((None, "message"))
+        msg["to"] = jid
+        msg["from"] = config.SCREEN_NAME
+        msg["type"] = 'chat'
+        msg.addElement("body", content=content)
+
+        self.outq.put(jid, msg, paced=False)
 
     def send_html(self, jid, body, html):
         msg = domish.Element((None, "message"))
@@ -128,18 +350,45 @@ class TwitterspyMessageProtocol(MessageProtocol):
         msg.addRawXml(u"<body>" + unicode(body) + u"</body>")
         msg.addRawXml(unicode(html))
 
-        self.send(msg)
+        self.outq.put(jid, msg)
+
+    def _dedup_key(self, key):
+        return string.translate(str(key), self.jidtrans)[0:128]
 
     def send_html_deduped(self, jid, body, html, key):
-        key = string.translate(str(key), self.jidtrans)[0:128]
-        def checkedSend(is_new, jid, body, html):
-            if is_new:
-                log.msg("Sending %s" % key)
-                self.send_html(jid, body, html)
+        self.send_html_deduped_batch(jid, [(body, html, key)])
+
+    def send_html_deduped_batch(self, jid, items):
+        """Send the (body, html, key) items the jid hasn't seen yet.
+
+        Above DIGEST_THRESHOLD new items, they're sent as one message."""
+        keys = [self._dedup_key(k) for b, h, k in items]
+        def checkedSend(res):
+            fresh = [item for (ok, is_new), item in zip(res, items)
+                     if ok and is_new]
+            metrics.dedup.inc(len(fresh), result='new')
+            metrics.dedup.inc(len(items) - len(fresh), result='seen')
+            delivery_log.debug("Sending %d of %d to %s",
+                               len(fresh), len(items), jid)
+            if DIGEST_THRESHOLD and len(fresh) > DIGEST_THRESHOLD:
+                self.send_html(jid,
+                    "%d new results\n\n" % len(fresh)
+                        + "\n\n".join(b for b, h, k in fresh),
+                    "%d new results<br/>\n<br/>\n" % len(fresh)
+                        + "<br/>\n<br/>\n".join(h for b, h, k in fresh))
             else:
-                log.msg("Skipping %s" % key)
+                for b, h, k in fresh:
+                    self.send_html(jid, b, h)
         global mc
-        mc.add(key, "x").addCallback(checkedSend, jid, body, html)
+        defer.DeferredList([mc.add(k, "x") for k in keys]
+                           ).addCallback(checkedSend)
+
+    def deliver(self, jids, results):
+        """Deliver (eid, plain, html) results to each of the bare jids."""
+        for jid in jids:
+            self.send_html_deduped_batch(jid,
+                [(plain, html, str(eid) + "@" + jid)
+                 for eid, plain, html in results])
 
     def get_user(self, msg, session):
         jid=JID(msg['from'])
@@ -151,9 +400,16 @@ class TwitterspyMessageProtocol(MessageProtocol):
             self.subscribe(jid)
         return rv;
 
+    def gone(self, entity):
+        """Forget messages held for a user with no resources left."""
+        if not scheduling.presence.is_online(entity.userhost()):
+            self.outq.discard(entity.userhost())
+
     def onError(self, msg):
         log.msg("Error received for %s: %s" % (msg['from'], msg.toXml()))
+        scheduling.presence.remove(JID(msg['from']))
         scheduling.unavailable_user(JID(msg['from']))
+        self.gone(JID(msg['from']))
 
     def onMessage(self, msg):
         try:
@@ -163,42 +419,54 @@ class TwitterspyMessageProtocol(MessageProtocol):
 
     def __onMessage(self, msg):
         if msg["type"] == 'chat' and hasattr(msg, "body") and msg.body:
-            self.typing_notification(msg['from'])
-            a=unicode(msg.body).strip().split(None, 1)
-            args = a[1] if len(a) > 1 else None
-            with models.Session() as session:
-                try:
-                    user = self.get_user(msg, session)
-                except:
-                    log.err()
-                    self.send_plain(msg['from'],
-                        "Stupid error processing message, please try again.")
-                    return
-                cmd = self.commands.get(a[0].lower())
-                if cmd:
-                    cmd(user, self, args, session)
-                else:
-                    d = None
-                    if user.auto_post:
-                        d=self.commands['post']
-                    elif a[0][0] == '@':
-                        d=self.commands['post']
-                    if d:
-                        d(user, self, unicode(msg.body).strip(), session)
-                    else:
-                        self.send_plain(msg['from'],
-                            "No such command: %s\n"
-                            "Send 'help' for known commands\n"
-                            "If you intended to post your message, "
-                            "please start your message with 'post', or see "
-                            "'help autopost'" % a[0])
-                try:
-                    session.commit()
-                except:
-                    log.err()
+            if sharding.is_peer(JID(msg['from'])):
+                sharding.peer_message(unicode(msg.body))
+                return
+            if not sharding.settled():
+                sharding.when_settled(self.onMessage, msg)
+                return
+            if sharding.answers(msg):
+                self.answer(msg)
         else:
             log.msg("Non-chat/body message: %s" % msg.toXml())
 
+    def answer(self, msg):
+        """Run the command in a user's message."""
+        self.typing_notification(msg['from'])
+        a=unicode(msg.body).strip().split(None, 1)
+        args = a[1] if len(a) > 1 else None
+        with models.Session() as session:
+            try:
+                user = self.get_user(msg, session)
+            except:
+                log.err()
+                self.send_plain(msg['from'],
+                    "Stupid error processing message, please try again.")
+                return
+            scheduling.users.touch(user.jid)
+            cmd = xmpp_commands.all_commands.lookup(a[0].lower())
+            if cmd:
+                cmd(user, self, args, session)
+            else:
+                d = None
+                if user.auto_post:
+                    d=xmpp_commands.all_commands['post']
+                elif a[0][0] == '@':
+                    d=xmpp_commands.all_commands['post']
+                if d:
+                    d(user, self, unicode(msg.body).strip(), session)
+                else:
+                    self.send_plain(msg['from'],
+                        "No such command: %s\n"
+                        "Send 'help' for known commands\n"
+                        "If you intended to post your message, "
+                        "please start your message with 'post', or see "
+                        "'help autopost'" % a[0])
+            try:
+                session.commit()
+            except:
+                log.err()
+
 class TwitterspyPresenceProtocol(PresenceClientProtocol):
 
     _tracking=-1
@@ -221,7 +489,7 @@ class TwitterspyPresenceProtocol(PresenceClientProtocol):
         except:
             log.err()
 
-    @models.wants_session
+    @models.wants_read_session
     def _update_presence_ready(self, session):
         tracking=session.query(models.Track).count()
         users=session.query(models.User).count()
@@ -238,18 +506,27 @@ class TwitterspyPresenceProtocol(PresenceClientProtocol):
         self._users = -1
 
     def availableReceived(self, entity, show=None, statuses=None, priority=0):
-        log.msg("Available from %s (%s, %s, pri=%s)" % (
-            entity.full(), show, statuses, priority))
-        if priority >= 0 and show not in ['xa', 'dnd']:
+        if sharding.is_peer(entity):
+            sharding.peer_available(entity.resource)
+            return
+        presence_log.debug("Available from %s (%s, %s, pri=%s)",
+                           entity.full(), show, statuses, priority)
+        if scheduling.presence.update(entity, show, priority):
             scheduling.available_user(entity)
         else:
-            log.msg("Marking jid unavailable due to negative priority or "
-                "being somewhat unavailable.")
+            presence_log.debug("Marking %s unavailable due to negative "
+                "priority or being somewhat unavailable.", entity.full())
             scheduling.unavailable_user(entity)
 
     def unavailableReceived(self, entity, statuses=None):
-        log.msg("Unavailable from %s" % entity.full())
+        if sharding.is_peer(entity):
+            sharding.peer_unavailable(entity.resource)
+            return
+        presence_log.debug("Unavailable from %s", entity.full())
+        scheduling.presence.remove(entity)
         scheduling.unavailable_user(entity)
+        if current_conn:
+            current_conn.gone(entity)
 
     @models.wants_session
     def subscribedReceived(self, entity, session):
@@ -0,0 +1,202 @@
+"""
+Recently fetched statuses, indexed so searches can be answered locally.
+
+Every result of a track poll goes into an inverted index of its words,
+tags and author (for from:), kept for max_age seconds and at most max_size
+statuses, oldest dropped first.
+
+A search can be answered from the index when each of its clauses is at
+least as narrow as a clause of some track whose last poll was within its
+polling interval:  everything the search would find has then been fetched
+too, give or take what's been posted since that poll.  Answers say how old
+the oldest poll they depend on is.
+"""
+
+from collections import deque
+import time
+
+import config
+import canonical
+import matcher
+import metrics
+
+local_searches = metrics.registry.counter('twitterspy_local_searches_total',
+    'Interactive searches, by whether the index answered them (hit), '
+    "didn't cover them (uncovered) or had too few results (short).")
+
+class RecentIndex(object):
+
+    # Compiled search matchers kept.
+    max_matchers = 1000
+
+    def __init__(self, max_size=20000, max_age=60 * 60):
+        self.max_size = max_size
+        self.max_age = max_age
+        # (time added, eid), oldest first
+        self.order = deque()
+        # eid -> (eid, author name, author uri, title, content)
+        self.docs = {}
+        # word or from:author -> set of eid
+        self.postings = {}
+        # canonical track -> (when its results were last fetched, how
+        # often it's polled)
+        self.fresh = {}
+        # canonical search -> Matcher
+        self.matchers = {}
+        # term -> [(track, required terms, excluded terms)] of track clauses
+        self.by_term = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _keys(self, entry):
+        keys = set(matcher.words(entry[3]))
+        keys.update(matcher.tags(entry[3]))
+        keys.add('from:' + entry[1].split(' ')[0].lower())
+        return keys
+
+    def add(self, entry, now=None):
+        """Index a fetched (eid, author name, author uri, title, content)."""
+        eid = entry[0]
+        if eid in self.docs:
+            return
+        now = now or time.time()
+        self.docs[eid] = entry
+        self.order.append((now, eid))
+        postings = self.postings
+        for k in self._keys(entry):
+            s = postings.get(k)
+            if s is None:
+                s = postings[k] = set()
+            s.add(eid)
+        self._expire(now)
+
+    def _expire(self, now):
+        order = self.order
+        while order and (len(order) > self.max_size
+                         or order[0][0] < now - self.max_age):
+            t, eid = order.popleft()
+            for k in self._keys(self.docs.pop(eid)):
+                s = self.postings.get(k)
+                if s is not None:
+                    s.discard(eid)
+                    if not s:
+                        del self.postings[k]
+
+    def fetched(self, query, interval, now=None):
+        """Note that a track polled every interval seconds was just indexed."""
+        now = now or time.time()
+        if query not in self.fresh:
+            try:
+                clauses = matcher.compile_query(query)
+            except matcher.Unmatchable:
+                clauses = []
+            for req, exc in clauses:
+                c = (query, frozenset(req), frozenset(exc))
+                for t in req:
+                    self.by_term.setdefault(t, []).append(c)
+        self.fresh[query] = (now, interval)
+
+    def _stale(self, query, now):
+        """Forget a track that has missed a poll."""
+        t, interval = self.fresh.get(query, (None, None))
+        if t is not None and t >= now - min(interval, self.max_age):
+            return False
+        self.fresh.pop(query, None)
+        for t, cs in self.by_term.items():
+            cs[:] = [c for c in cs if c[0] != query]
+            if not cs:
+                del self.by_term[t]
+        return True
+
+    def _covered(self, req, exc, now):
+        """When the freshest track covering a clause was fetched, or None."""
+        req = set(req)
+        exc = set(exc)
+        rv = None
+        for t in req:
+            for query, treq, texc in list(self.by_term.get(t, ())):
+                if treq <= req and texc <= exc and not self._stale(query, now):
+                    rv = max(rv, self.fresh[query][0])
+        return rv
+
+    def _matcher(self, key):
+        m = self.matchers.get(key)
+        if m is None:
+            if len(self.matchers) >= self.max_matchers:
+                self.matchers.clear()
+            m = self.matchers[key] = matcher.Matcher([key])
+        return m
+
+    def search(self, query, limit=3, now=None):
+        """Search the index, if it's sure to have what the query would find.
+
+        Returns the newest matching entries (up to limit) and when the
+        oldest of the tracks covering them was fetched, or None if the
+        query isn't covered by tracks polled on schedule."""
+        key = canonical.canonicalize(query)
+        try:
+            clauses = matcher.compile_query(key)
+        except matcher.Unmatchable:
+            return None
+        now = now or time.time()
+        self._expire(now)
+        as_of = now
+        for req, exc in clauses:
+            t = self._covered(req, exc, now)
+            if t is None:
+                return None
+            as_of = min(as_of, t)
+        candidates = set()
+        for req, exc in clauses:
+            sets = [self.postings.get(w, ()) for term in req for w in term]
+            sets.sort(key=len)
+            if sets and sets[0]:
+                found = set(sets[0])
+                for s in sets[1:]:
+                    found &= s
+                candidates |= found
+        # Check phrases and exclusions properly.
+        m = self._matcher(key)
+        rv = [self.docs[eid] for eid in candidates
+              if m.match(self.docs[eid][3],
+                         self.docs[eid][1].split(' ')[0])]
+        rv.sort(reverse=True)
+        return rv[:limit], as_of
+
+    def answer(self, query, limit=3):
+        """Get results for an interactive search, or None to ask twitter.
+
+        Only answers when the index covers the query and has at least limit
+        results for it.  Returns (entries, when fetched)."""
+        rv = self.search(query, limit)
+        if rv is None:
+            local_searches.inc(result='uncovered')
+        elif len(rv[0]) < limit:
+            local_searches.inc(result='short')
+            rv = None
+        else:
+            local_searches.inc(result='hit')
+        if rv is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return rv
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+index = RecentIndex(config.getint('general', 'recent_statuses', 20000),
+                    config.getint('general', 'recent_age', 60 * 60))
+
+metrics.registry.gauge('twitterspy_recent_statuses',
+                       'Statuses in the recent search index.',
+                       lambda: len(index))
+metrics.registry.gauge('twitterspy_local_search_hit_ratio',
+                       'Fraction of interactive searches answered locally, '
+                       'each one a search API call saved.',
+                       lambda: index.hit_ratio)
@@ -0,0 +1,198 @@
+"""
+Rendering of collected statuses into deliverable messages.
+
+The render functions take plain tuples, so they can run either inline on
+the reactor or in a pool of worker processes (render_workers in the
+config).
+"""
+
+import signal
+import multiprocessing
+
+from twisted.python import log
+from twisted.internet import defer, reactor
+
+def _unescape(content):
+    return content.replace("&lt;", "<").replace("&gt;", ">"
+                                               ).replace('&amp;', '&')
+
+def render_search(entries):
+    """Render (id, author name, author uri, title, content) search entries.
+
+    Returns sorted (eid, plain, html) tuples."""
+    rv = []
+    for eid, name, uri, title, content in entries:
+        u = name.split(' ')[0]
+        plain = u + ": " + title
+        html = "<a href='%s'>%s</a>: %s" % (uri, u, _unescape(content))
+        rv.append((eid, plain, html))
+    rv.sort()
+    return rv
+
+def render_statuses(statuses):
+    """Render (type, id, screen name, text) timeline statuses.
+
+    The type ('direct', 'friend' or None for tracks) prefixes the message.
+    Returns sorted (eid, plain, html) tuples."""
+    rv = []
+    for type, eid, u, text in statuses:
+        aurl = "http://twitter.com/" + u
+        if type:
+            plain = "[%s] %s: %s" % (type, u, text)
+            html = "[%s] <a href='%s'>%s</a>: %s" % (type, aurl, u, text)
+        else:
+            plain = u + ": " + text
+            html = "<a href='%s'>%s</a>: %s" % (aurl, u, text)
+        rv.append((eid, plain, html))
+    rv.sort()
+    return rv
+
+def _init_worker():
+    # Workers are forked from the running reactor, and would otherwise
+    # keep its signal handling and just log the SIGTERM from terminate().
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _call(f, items):
+    # Exceptions don't make it back through apply_async's callback.
+    try:
+        return True, f(items)
+    except Exception, e:
+        return False, repr(e)
+
+class Renderer(object):
+    """Run render functions inline or in a process pool."""
+
+    # Smaller batches aren't worth the trip to another process.
+    min_batch = 20
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.pool = None
+
+    def start(self):
+        """Start the worker processes, if any.
+
+        Called once the reactor is running, so they aren't forked before
+        twistd daemonizes.  Until then everything is rendered inline."""
+        if self.workers and not self.pool:
+            log.msg("Starting %d render workers" % self.workers)
+            self.pool = multiprocessing.Pool(self.workers, _init_worker)
+
+    def stop(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+    def _done(self, d, res):
+        ok, v = res
+        if ok:
+            d.callback(v)
+        else:
+            d.errback(RuntimeError("Error rendering: " + v))
+
+    def render(self, f, items):
+        """Get a Deferred result of f(items)."""
+        if not self.pool or len(items) < self.min_batch:
+            return defer.maybeDeferred(f, items)
+        d = defer.Deferred()
+        self.pool.apply_async(_call, (f, items), callback=lambda res:
+                              reactor.callFromThread(self._done, d, res))
+        return d
+
+class StatusCache(object):
+    """Rendered statuses by (type, status id), least recently used first out.
+
+    Friends' timelines overlap a lot, so a status is usually rendered for
+    one follower and then found here for the rest.  The size is bounded by
+    a rough count of the bytes held."""
+
+    # Per entry, beyond the strings themselves.
+    overhead = 200
+    # Only statuses of these types are kept.  Direct messages are private
+    # to one user, so they're rendered every time and never held here.
+    shared = ('friend',)
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> link; links are [prev, next, key, value, size] in a ring
+        # around the root, most recently used just before it.
+        self.map = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+
+    def __len__(self):
+        return len(self.map)
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        last = self.root[0]
+        link[0] = last
+        link[1] = self.root
+        last[1] = link
+        self.root[0] = link
+
+    def get(self, key):
+        link = self.map.get(key)
+        if link is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def put(self, key, value):
+        if not self.max_bytes:
+            return
+        old = self.map.pop(key, None)
+        if old is not None:
+            self._unlink(old)
+            self.bytes -= old[4]
+        size = self.overhead + sum(len(v) for v in value[1:])
+        link = [None, None, key, value, size]
+        self._append(link)
+        self.map[key] = link
+        self.bytes += size
+        while self.bytes > self.max_bytes and self.map:
+            oldest = self.root[1]
+            self._unlink(oldest)
+            del self.map[oldest[2]]
+            self.bytes -= oldest[4]
+
+    def render(self, renderer, statuses):
+        """Render (type, id, screen name, text) statuses, reusing any
+        already rendered (and keeping them, if of a shared type).
+
+        Returns a Deferred of sorted (eid, plain, html) tuples."""
+        found = []
+        missing = []
+        for s in statuses:
+            if s[0] not in self.shared:
+                missing.append(s)
+                continue
+            r = self.get((s[0], s[1]))
+            if r is None:
+                missing.append(s)
+            else:
+                found.append(r)
+        if not missing:
+            found.sort()
+            return defer.succeed(found)
+        def rendered(results):
+            types = dict((s[1], s[0]) for s in missing)
+            for r in results:
+                t = types.get(r[0])
+                if t in self.shared:
+                    self.put((t, r[0]), r)
+            return sorted(found + results)
+        return renderer.render(render_statuses, missing).addCallback(rendered)
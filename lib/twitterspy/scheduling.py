@@ -1,36 +1,93 @@
+import math
+import time
+import zlib
+import datetime
+import json
+import base64
 import bisect
 import random
+import urllib
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import task, defer, reactor, threads
+from twisted.web import client as webclient
 from twisted.words.protocols.jabber.jid import JID
 
 import twitter
+import txml
 import protocol
 
 import models
 import moodiness
 import config
-
-search_semaphore = defer.DeferredSemaphore(tokens=5)
-private_semaphore = defer.DeferredSemaphore(tokens=20)
-available_sem = defer.DeferredSemaphore(tokens=2)
-
-MAX_REQUESTS = 20000
+import canonical
+import matcher
+import sharding
+import rendering
+import metrics
+import slog
+import snapshot
+import history
+import recent
+import limiter
+
+search_log = slog.category('search')
+private_log = slog.category('private')
+presence_log = slog.category('presence')
+
+search_limiter = limiter.Limiter('search', 5, 1, 20)
+private_limiter = limiter.Limiter('private', 20, 5, 50)
+available_limiter = limiter.Limiter('available', 2, 1, 8)
+
+# Interactive searches have someone waiting on them.
+INTERACTIVE = 1e9
+
+MAX_REQUESTS = config.getint('general', 'max_requests', 20000)
 REQUEST_PERIOD = 3600
 
 QUERY_FREQUENCY = 15 * 60
 USER_FREQUENCY = 3 * 60
 
+# Users with nothing delivered and no commands for this long hibernate
+# (0 never), and hibernating users are checked for news this often.
+HIBERNATE_AFTER = config.getint('general', 'hibernate_after', 7 * 86400)
+HIBERNATE_CHECK = 60 * 60
+# Sleepers are checked a slice at a time, spread over each HIBERNATE_CHECK,
+# and a slice may spend at most this percentage of its part of the hour's
+# requests (or of what's left of them).
+SLEEP_SLICES = 12
+SLEEP_SHARE = config.getint('general', 'sleeper_request_share', 25)
+# Last activity is written to the database at most this often per user.
+ACTIVITY_SAVE_EVERY = 60 * 60
+
 available_requests = MAX_REQUESTS
 reported_empty = False
 empty_resets = 0
 
+class _CountedAPI(object):
+    """Count the calls made to each API endpoint."""
+
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, attr):
+        f = getattr(self.api, attr)
+        def counted(*args, **kwargs):
+            metrics.api_calls.inc(endpoint=attr)
+            return f(*args, **kwargs)
+        return counted
+
+# Where to find twitter, if not at the usual place.
+TWITTER_URLS = dict((k, v) for k, v in
+                    [('base_url', config.get('twitter', 'base_url')),
+                     ('search_url', config.get('twitter', 'search_url'))]
+                    if v)
+
 def getTwitterAPI(*args):
     global available_requests, reported_empty
     if available_requests > 0:
         available_requests -= 1
-        return twitter.Twitter(*args)
+        return _CountedAPI(twitter.Twitter(*args, **TWITTER_URLS))
     else:
         if not reported_empty:
             admin_message(":-x Just ran out of requests for the hour.")
@@ -38,11 +95,12 @@ def getTwitterAPI(*args):
             if protocol.presence_conn:
                 protocol.presence_conn.update_presence()
         log.msg("Out of requests.  :(")
-        # Return something that just generates deferreds that error.
+        # Return something that just generates deferreds that error,
+        # without counting against the limiters' view of twitter.
         class ErrorGenerator(object):
             def __getattr__(self, attr):
                 def error_generator(*args):
-                    d = defer.Deferred()
+                    d = limiter.local(defer.Deferred())
                     reactor.callLater(0, d.errback,
                         RuntimeError(
                             "There are no more available twitter requests."))
@@ -66,55 +124,186 @@ def resetRequests():
     log.msg("Available requests are reset to %d" % available_requests)
 
 class SearchCollector(object):
+    """Collect search results as they're parsed, for rendering after."""
 
     def __init__(self, last_id=0):
         self.results=[]
+        self.entries=[]
         self.last_id = last_id
 
     def gotResult(self, entry):
         eid = int(entry.id.split(':')[-1])
         self.last_id = max(self.last_id, eid)
-        u = entry.author.name.split(' ')[0]
-        plain=u + ": " + entry.title
-        hcontent=entry.content.replace("&lt;", "<"
-                                       ).replace("&gt;", ">"
-                                       ).replace('&amp;', '&')
-        html="<a href='%s'>%s</a>: %s" % (entry.author.uri, u, hcontent)
-        bisect.insort(self.results, (eid, plain, html))
+        t = (eid, entry.author.name, entry.author.uri, entry.title,
+             entry.content)
+        self.entries.append(t)
+
+    def gotStatus(self, status):
+        """Collect a timeline-style status (as from the streaming API)."""
+        eid = int(status.id)
+        self.last_id = max(self.last_id, eid)
+        bisect.insort(self.results, rendering.render_statuses(
+                [(None, eid, status.user.screen_name, status.text)])[0])
+
+    def render(self, *args):
+        """Render the collected entries into results.
+
+        Returns a Deferred that fires with this collector."""
+        def rendered(results):
+            self.results = sorted(self.results + results)
+            return self
+        entries, self.entries = self.entries, []
+        return renderer.render(rendering.render_search, entries
+                               ).addCallback(rendered)
+
+def intern_jid(j):
+    """Share one copy of each JID string between all the places it's kept.
+
+    Interned strings are freed once nothing uses them any more."""
+    try:
+        return intern(str(j))
+    except UnicodeError:
+        return j
+
+class PresenceTable(object):
+    """The presence of every resource we've heard from, by bare JID.
+
+    Kept up to date from presence events, so delivery can skip users with no
+    resource that should get messages (all dnd, xa or negative priority)
+    without looking at their resources."""
+
+    def __init__(self):
+        # bare jid -> {resource: eligible}
+        self.states = {}
+        # bare jid -> [eligible resource]
+        self.eligible = {}
+
+    def update(self, entity, show, priority):
+        """Record an available presence.
+
+        Returns whether the resource should get messages."""
+        ok = priority >= 0 and show not in ('xa', 'dnd')
+        self._set(entity.userhost(), entity.resource, ok)
+        return ok
+
+    def remove(self, entity):
+        self._set(entity.userhost(), entity.resource, None)
+
+    def _set(self, bare, resource, ok):
+        bare = intern_jid(bare)
+        states = self.states.setdefault(bare, {})
+        if ok is None:
+            states.pop(resource, None)
+        else:
+            states[resource] = ok
+        if not states:
+            del self.states[bare]
+        eligible = [r for r, e in states.iteritems() if e]
+        if eligible:
+            self.eligible[bare] = eligible
+        else:
+            self.eligible.pop(bare, None)
+
+    def is_eligible(self, bare):
+        return bare in self.eligible
+
+    def is_online(self, bare):
+        """Has the user any resource available at all?"""
+        return bare in self.states
+
+    def resources(self, bare):
+        return self.eligible.get(bare, [])
+
+    def full_jids(self, bare):
+        return [bare + '/' + r if r else bare for r in self.resources(bare)]
+
+    def entities(self):
+        return [JID(j) for bare in self.eligible for j in self.full_jids(bare)]
+
+    def clear(self):
+        self.states.clear()
+        self.eligible.clear()
+
+# Every resource we've heard from, whether or not this worker owns it.
+presence = PresenceTable()
 
 class JidSet(set):
 
     def bare_jids(self):
-        return set([JID(j).userhost() for j in self])
+        """The bare JIDs in this set that should get messages now."""
+        return set(b for b in (j.split('/', 1)[0] for j in self)
+                   if presence.is_eligible(b))
 
 class Query(JidSet):
 
     loop_time = QUERY_FREQUENCY
 
-    def __init__(self, query, last_id):
+    def __init__(self, query, last_id, then=None):
         super(Query, self).__init__()
         self.query = query
         self.last_id = last_id
-
-        r=random.Random()
-        then = r.randint(1, min(60, self.loop_time / 2))
-        log.msg("Starting %s in %ds" % (self.query, then))
+        # When this last polled, and the recent average results per poll.
+        self.polled = None
+        self.yield_avg = 1.0
+        # Bare JIDs to wait for before the first poll, and whether it's due.
+        self.awaiting = None
+        self.held = False
+
+        if then is None:
+            r=random.Random()
+            then = r.randint(1, min(60, self.loop_time / 2))
+        search_log.debug("Starting %s in %ds", self.query, then)
         self.loop = None
-        reactor.callLater(then, self.start)
+        self.start_call = reactor.callLater(then, self.start)
+
+    def next_due(self):
+        """When this query will next poll, in reactor time."""
+        if self.loop and self.loop.call:
+            return self.loop.call.getTime()
+        if self.start_call and self.start_call.active():
+            return self.start_call.getTime()
+
+    def priority(self):
+        """How much this poll matters compared to others waiting.
+
+        More watchers, longer since the last poll and more results found
+        per poll lately all make it more urgent."""
+        now = reactor.seconds()
+        waited = now - self.polled if self.polled else self.loop_time
+        return (math.log(2 + len(self)) * (waited / self.loop_time)
+                * (1 + self.yield_avg))
+
+    def _fetched(self, x, results):
+        self.polled = reactor.seconds()
+        self.yield_avg += (len(results.entries) - self.yield_avg) * 0.3
+        # Only track polls go in the index;  they're what keep it complete.
+        for t in results.entries:
+            recent.index.add(t)
+        recent.index.fetched(self.query, self.loop_time)
+        return x
+
+    def _render(self, x, results):
+        # Nobody to send to, don't bother formatting anything.
+        if self.bare_jids():
+            return results.render()
 
     def _sendMessages(self, something, results):
+        metrics.search_results.observe(len(results.results))
+        jids = self.bare_jids()
+        if not jids or results.entries:
+            # Nobody to send to (or nobody was when rendering).  Leave the
+            # cursor where it is, so a later poll finds these again.
+            return
         self.last_id = results.last_id
-        conn = protocol.current_conn
-        for eid, plain, html in results.results:
-            for jid in self.bare_jids():
-                key = str(eid) + "@" + jid
-                conn.send_html_deduped(jid, plain, html, key)
+        if results.results:
+            protocol.current_conn.deliver(jids, results.results)
+            if history.archive:
+                history.archive.append(self.query, results.results)
 
     @models.wants_session
     def _deferred_write(self, theId, session):
-        t=session.query(models.Track).filter_by(query=self.query).one()
-        t.max_seen = theId
         try:
+            models.Track.set_max_seen(self.query, theId, session)
             session.commit()
         except:
             log.err()
@@ -123,60 +312,126 @@ class Query(JidSet):
         if old_id != self.last_id:
             threads.deferToThread(self._deferred_write, self.last_id)
 
+    def streamed(self, status):
+        """Deliver a status the stream matched to this query.
+
+        The cursor is saved by the stream every so often, not per status."""
+        results = SearchCollector(self.last_id)
+        results.gotStatus(status)
+        self._sendMessages(None, results)
+
     def __call__(self):
-        # Don't bother if we're not connected...
-        if protocol.current_conn:
-            global search_semaphore
-            search_semaphore.run(self._do_search)
+        # Don't bother if we're not connected, the stream has it covered or
+        # searches are failing anyway.
+        if (protocol.current_conn and not firehose.covers(self.query)
+            and breaker.allow(self)):
+            # Only the search itself runs under the limiter, so it sees the
+            # API's latency and failures and not our own rendering.
+            metrics.run_timed(search_limiter.prioritized(self.priority()),
+                              'search', self._do_search
+                ).addCallback(self._gotResults
+                ).addErrback(self._reportError)
 
     def _reportError(self, e):
-        log.msg("Error in search %s: %s" % (self.query, str(e)))
+        search_log.info("Error in search %s: %s", self.query, e)
 
     def _do_search(self):
-        log.msg("Searching %s" % self.query)
+        """Search, firing with the SearchCollector holding the results."""
+        search_log.debug("Searching %s", self.query)
         params = {}
         if self.last_id > 0:
             params['since_id'] = str(self.last_id)
         results=SearchCollector(self.last_id)
         return getTwitterAPI().search(self.query, results.gotResult,
             params
+            ).addCallback(metrics.search_seconds.time()
             ).addCallback(moodiness.moodiness.markSuccess
             ).addErrback(moodiness.moodiness.markFailure
+            ).addCallbacks(breaker.succeeded, breaker.failed
+            ).addCallback(lambda x: results)
+
+    def _gotResults(self, results):
+        self._fetched(None, results)
+        return defer.maybeDeferred(self._render, None, results
             ).addCallback(self._sendMessages, results
-            ).addCallback(self._save_track_id, self.last_id
-            ).addErrback(self._reportError)
+            ).addCallback(self._save_track_id, self.last_id)
+
+    def hold(self, watchers):
+        """Don't start polling until all these bare JIDs are back.
+
+        (Or until release() is called.)"""
+        self.awaiting = set(watchers)
+
+    def returned(self, bare):
+        if self.awaiting:
+            self.awaiting.discard(bare)
+            if not self.awaiting:
+                self.release()
+
+    def release(self):
+        self.awaiting = None
+        if self.held:
+            self.held = False
+            self.start()
 
     def start(self):
+        self.start_call = None
+        if self.awaiting:
+            search_log.debug("Holding %s for %d watchers", self.query,
+                             len(self.awaiting))
+            self.held = True
+            return
         self.loop = task.LoopingCall(self)
         self.loop.start(self.loop_time)
 
     def stop(self):
-        log.msg("Stopping query %s" % self.query)
+        search_log.debug("Stopping query %s", self.query)
+        self.awaiting = None
+        self.held = False
+        if self.start_call and self.start_call.active():
+            self.start_call.cancel()
+        self.start_call = None
         if self.loop:
             self.loop.stop()
             self.loop = None
 
 class QueryRegistry(object):
+    """Running queries, keyed by their canonical form.
+
+    Equivalent tracks from different users share a single Query (and so a
+    single search and cursor)."""
 
     def __init__(self):
         self.queries = {}
+        # Bumped whenever the set of queries changes.
+        self.generation = 0
 
     def add(self, user, query_str, last_id):
-        log.msg("Adding %s: %s" % (user, query_str))
-        if not self.queries.has_key(query_str):
-            self.queries[query_str] = Query(query_str, last_id)
-        self.queries[query_str].add(user)
+        presence_log.debug("Adding %s: %s", user, query_str)
+        key = canonical.canonicalize(query_str)
+        if not sharding.owns(key):
+            return
+        q = self.queries.get(key)
+        if q is None:
+            q = self.queries[key] = Query(key, last_id)
+            self.generation += 1
+        elif last_id > q.last_id:
+            q.last_id = last_id
+        q.add(intern_jid(user))
+        q.returned(user.split('/', 1)[0])
 
     def untracked(self, user, query):
-        q = self.queries.get(query)
+        key = canonical.canonicalize(query)
+        q = self.queries.get(key)
         if q:
             q.discard(user)
             if not q:
                 q.stop()
-                del self.queries[query]
+                del self.queries[key]
+                self.generation += 1
 
     def remove(self, user):
-        log.msg("Removing %s" % user)
+        presence_log.debug("Removing %s", user)
         for k in list(self.queries.keys()):
             self.untracked(user, k)
 
@@ -185,11 +440,116 @@ class QueryRegistry(object):
             for j in jids:
                 self.untracked(j, k)
 
+class Backoff(object):
+    """Skip polls of something that has been quiet for a while.
+
+    After n consecutive empty polls, the next min(n, max_skip) rounds are
+    skipped."""
+
+    max_skip = 9
+
+    def __init__(self):
+        self.reset()
+
+    def due(self):
+        if self.skip > 0:
+            self.skip -= 1
+            return False
+        return True
+
+    def record(self, activity):
+        if activity:
+            self.reset()
+        else:
+            self.idle += 1
+            self.skip = min(self.idle, self.max_skip)
+
+    def reset(self):
+        self.idle = 0
+        self.skip = 0
+
+# Private API requests made, by endpoint only:  a label per user would be a
+# series per user.  Each user's own count is UserStuff.requests, shown by
+# the status command.
+private_requests = metrics.registry.counter(
+    'twitterspy_private_requests_total',
+    'Private API requests made for logged in users, by endpoint.')
+
+class SharedTimelines(object):
+    """Friend timelines recently fetched, by twitter account.
+
+    Every JID logged in to the same account shares one fetch per polling
+    period instead of making its own."""
+
+    max_age = USER_FREQUENCY
+
+    def __init__(self):
+        # username -> [fetched_at, since_id, entries, waiters or None]
+        self.timelines = {}
+        self.shared = 0
+        self.pruned_at = time.time()
+
+    def _prune(self, now):
+        if now - self.pruned_at > self.max_age:
+            for k, t in self.timelines.items():
+                if t[0] < now - self.max_age and t[3] is None:
+                    del self.timelines[k]
+            self.pruned_at = now
+
+    def get(self, username, since_id, fetch):
+        """Get a Deferred list of friend statuses since the given id.
+
+        fetch(delegate, params) is called to get them if nobody else has
+        recently.  The Deferred is marked local if twitter wasn't asked."""
+        d = defer.Deferred()
+        now = time.time()
+        t = self.timelines.get(username)
+        if t is None or t[0] < now - self.max_age or t[1] > since_id:
+            self._prune(now)
+            t = [now, since_id, [], []]
+            self.timelines[username] = t
+            def done(x):
+                waiters, t[3] = t[3], None
+                for d in waiters:
+                    d.callback(t[2])
+            def failed(e):
+                if self.timelines.get(username) is t:
+                    del self.timelines[username]
+                waiters, t[3] = t[3], None
+                for d in waiters:
+                    d.errback(e)
+            fetched = fetch(t[2].append, {'since_id': str(since_id)})
+            if limiter.is_local(fetched):
+                limiter.local(d)
+            fetched.addCallbacks(done, failed)
+        else:
+            self.shared += 1
+            limiter.local(d)
+        if t[3] is None:
+            d.callback(t[2])
+        else:
+            t[3].append(d)
+        return d
+
+shared_timelines = SharedTimelines()
+
+def _fork(d):
+    """Get a new Deferred firing with d's result, leaving d's as it is."""
+    d2 = defer.Deferred()
+    def f(x):
+        if isinstance(x, failure.Failure):
+            d2.errback(x)
+        else:
+            d2.callback(x)
+        return x
+    d.addBoth(f)
+    return d2
+
 class UserStuff(JidSet):
 
     loop_time = USER_FREQUENCY
 
-    def __init__(self, short_jid, friends_id, dm_id):
+    def __init__(self, short_jid, friends_id, dm_id, active_at=None):
         super(UserStuff, self).__init__()
         self.short_jid = short_jid
         self.last_friend_id = friends_id
@@ -199,22 +559,34 @@ class UserStuff(JidSet):
         self.password = None
         self.loop = None
 
+        self.requests = 0
+        self.dm_backoff = Backoff()
+        self.friends_backoff = Backoff()
+        # Last command or private delivery, for hibernation, and when that
+        # was last written to the database.
+        self.active_at = self.saved_active_at = active_at or time.time()
+
     def _format_message(self, type, entry, results):
         s = getattr(entry, 'sender', None)
         if not s:
             s=entry.user
-        u = s.screen_name
-        plain="[%s] %s: %s" % (type, u, entry.text)
-        aurl = "http://twitter.com/" + u
-        html="[%s] <a href='%s'>%s</a>: %s" % (type, aurl, u, entry.text)
-        bisect.insort(results, (entry.id, plain, html))
+        results.append((type, entry.id, s.screen_name, entry.text))
+
+    def bare_jids(self):
+        if presence.is_eligible(self.short_jid):
+            return [self.short_jid]
+        return []
+
+    def _deliver(self, messages):
+        if protocol.current_conn:
+            protocol.current_conn.deliver(self.bare_jids(), messages)
+            if messages:
+                users.delivered(self)
 
     def _deliver_messages(self, whatever, messages):
-        conn = protocol.current_conn
-        for eid, plain, html in messages:
-            for jid in self.bare_jids():
-                key = str(eid) + "@" + jid
-                conn.send_html_deduped(jid, plain, html, key)
+        if messages and presence.is_eligible(self.short_jid):
+            return status_cache.render(renderer, messages
+                                       ).addCallback(self._deliver)
 
     def _gotDMResult(self, results):
         def f(entry):
@@ -222,17 +594,27 @@ class UserStuff(JidSet):
             self._format_message('direct', entry, results)
         return f
 
+    def _gotFriends(self, entries, results, since_id):
+        f = self._gotFriendsResult(results)
+        for entry in entries:
+            if int(entry.id) > since_id:
+                f(entry)
+        self.friends_backoff.record(results)
+
     def _gotFriendsResult(self, results):
         def f(entry):
             self.last_friend_id = max(self.last_friend_id, int(entry.id))
             self._format_message('friend', entry, results)
         return f
 
+    def _record_dms(self, x, results):
+        self.dm_backoff.record(results)
+        return x
+
     @models.wants_session
     def _deferred_write(self, jid, mprop, new_val, session):
-        u = models.User.by_jid(jid, session)
-        setattr(u, mprop, new_val)
         try:
+            models.User.set_column(jid, mprop, new_val, session)
             session.commit()
         except:
             log.err()
@@ -248,56 +630,181 @@ class UserStuff(JidSet):
 
     def __call__(self):
         if self.username and self.password and protocol.current_conn:
-            global private_semaphore
-            private_semaphore.run(self._get_user_stuff)
+            dm_due, friends_due = self._due()
+            if dm_due or friends_due:
+                # Failures were reported as each fetch's results were.
+                metrics.run_timed(private_limiter, 'private',
+                                  self._get_user_stuff, dm_due, friends_due
+                    ).addErrback(lambda e: None)
 
     def _reportError(self, e):
-        log.msg("Error getting user data for %s: %s" % (self.short_jid, str(e)))
+        private_log.info("Error getting user data for %s: %s",
+                         self.short_jid, e)
+
+    def active(self):
+        """Note activity now, saving it now and then so idle time
+        survives reconnects and rebalancing."""
+        now = time.time()
+        self.active_at = now
+        if now - self.saved_active_at > ACTIVITY_SAVE_EVERY:
+            self.saved_active_at = now
+            threads.deferToThread(self._deferred_write, self.short_jid,
+                                  'active_at',
+                                  datetime.datetime.fromtimestamp(now))
+
+    def touch(self):
+        """Note activity from the user, so polling resumes at full speed."""
+        self.active()
+        self.dm_backoff.reset()
+        self.friends_backoff.reset()
+
+    def _private_call(self, tw, endpoint):
+        def f(delegate, params):
+            private_requests.inc(endpoint=endpoint)
+            self.requests += 1
+            return getattr(tw, endpoint)(delegate, params).addCallbacks(
+                moodiness.moodiness.success(endpoint),
+                moodiness.moodiness.failure(endpoint))
+        return f
 
-    def _get_user_stuff(self):
-        log.msg("Getting privates for %s" % self.short_jid)
-        params = {}
-        if self.last_dm_id > 0:
-            params['since_id'] = str(self.last_dm_id)
+    def _due(self):
+        """Which of (direct messages, friends) to fetch now."""
+        # Back off further while twitter is rate limiting these calls.
+        mood = moodiness.moodiness
+        dm_due = (self.dm_backoff.due()
+                  and not mood.throttled('direct_messages'))
+        friends_due = (self.last_friend_id is not None
+                       and self.friends_backoff.due()
+                       and not mood.throttled('friends'))
+        return dm_due, friends_due
+
+    def _get_user_stuff(self, dm_due, friends_due):
+        """Fetch what's due, firing when the fetches are done.
+
+        Recording and delivering the results hangs off a copy of each
+        fetch, so what's waited for here is only the API calls, and it
+        fails if any of them did.  It's marked local if none of them went
+        to twitter."""
+        private_log.debug("Getting privates for %s", self.short_jid)
         tw = getTwitterAPI(self.username, self.password)
-        dm_list=[]
-        tw.direct_messages(self._gotDMResult(dm_list), params).addCallback(
-            self._maybe_update_prop('last_dm_id', 'direct_message_id')
-            ).addCallback(self._deliver_messages, dm_list
-            ).addErrback(self._reportError)
+        fetches = []
+        if dm_due:
+            params = {}
+            if self.last_dm_id > 0:
+                params['since_id'] = str(self.last_dm_id)
+            dm_list=[]
+            d = self._private_call(tw, 'direct_messages')(
+                self._gotDMResult(dm_list), params)
+            fetches.append(d)
+            _fork(d).addCallback(self._record_dms, dm_list
+                ).addCallback(
+                    self._maybe_update_prop('last_dm_id', 'direct_message_id')
+                ).addCallback(self._deliver_messages, dm_list
+                ).addErrback(self._reportError)
 
-        if self.last_friend_id is not None:
+        if friends_due:
             friend_list=[]
-            tw.friends(self._gotFriendsResult(friend_list),
-                {'since_id': str(self.last_friend_id)}).addCallback(
+            d = shared_timelines.get(self.username, self.last_friend_id,
+                                     self._private_call(tw, 'friends'))
+            fetches.append(d)
+            _fork(d).addCallback(self._gotFriends, friend_list,
+                                 self.last_friend_id
+                ).addCallback(
                     self._maybe_update_prop(
                         'last_friend_id', 'friend_timeline_id')
                 ).addCallback(self._deliver_messages, friend_list
                 ).addErrback(self._reportError)
 
+        rv = defer.DeferredList(fetches, fireOnOneErrback=True,
+                                consumeErrors=True)
+        if all(limiter.is_local(f) for f in fetches):
+            limiter.local(rv)
+        return rv
+
     def start(self):
-        log.msg("Starting %s" % self.short_jid)
+        private_log.debug("Starting %s", self.short_jid)
         self.loop = task.LoopingCall(self)
         self.loop.start(self.loop_time, now=False)
 
     def stop(self):
         if self.loop:
-            log.msg("Stopping user %s" % self.short_jid)
+            private_log.debug("Stopping user %s", self.short_jid)
             self.loop.stop()
             self.loop = None
 
+class Hibernating(object):
+    """All that's kept of an idle user until there's reason to wake up."""
+
+    __slots__ = ('short_jid', 'jids', 'last_friend_id', 'last_dm_id',
+                 'username', 'password')
+
+    def __init__(self, stuff):
+        self.short_jid = intern_jid(stuff.short_jid)
+        self.jids = tuple(intern_jid(j) for j in stuff)
+        self.last_friend_id = stuff.last_friend_id
+        self.last_dm_id = stuff.last_dm_id
+        self.username = stuff.username
+        self.password = stuff.password
+
+    def expand(self):
+        stuff = UserStuff(self.short_jid, self.last_friend_id, self.last_dm_id)
+        stuff.update(self.jids)
+        stuff.username = self.username
+        stuff.password = self.password
+        # Idle until something wakes it, which notes (and saves) activity.
+        stuff.active_at = stuff.saved_active_at = 0
+        return stuff
+
+def _sleep_slice(short_jid):
+    return (zlib.crc32(short_jid) & 0xffffffff) % SLEEP_SLICES
+
+def _sleeper_budget():
+    """How many sleepers one slice may check, at two requests each."""
+    requests = min(MAX_REQUESTS / SLEEP_SLICES, available_requests)
+    return max(0, requests * SLEEP_SHARE / 100 / 2)
+
 class UserRegistry(object):
+    """Private polling for each user with an available resource.
+
+    Users who go HIBERNATE_AFTER without a command or a private delivery
+    are boiled down to a Hibernating record, and polled once every
+    HIBERNATE_CHECK (budget permitting) instead of every USER_FREQUENCY.
+    They wake up when they send a command or a check finds something to
+    deliver.  (Track results don't need any of this to reach them.)
+
+    When users last did something is saved with them, so idle time
+    carries over when they're loaded again."""
 
     def __init__(self):
         self.users = {}
+        self.sleeping = {}
+        self.checking = None
+        # The slice of sleepers to check next.
+        self.slice = 0
+
+    def __len__(self):
+        return len(self.users) + len(self.sleeping)
 
-    def add(self, short_jid, full_jid, friends_id, dm_id):
-        log.msg("Adding %s as %s" % (short_jid, full_jid))
+    def add(self, short_jid, full_jid, friends_id, dm_id, active_at=None):
+        presence_log.debug("Adding %s as %s", short_jid, full_jid)
+        if not sharding.owns(short_jid):
+            return
+        short_jid = intern_jid(short_jid)
+        rec = self.sleeping.get(short_jid)
+        if rec:
+            rec.jids = tuple(set(rec.jids + (intern_jid(full_jid),)))
+            return
         if not self.users.has_key(short_jid):
-            self.users[short_jid] = UserStuff(short_jid, friends_id, dm_id)
-        self.users[short_jid].add(full_jid)
+            self.users[short_jid] = UserStuff(short_jid, friends_id, dm_id,
+                                              active_at)
+        self.users[short_jid].add(intern_jid(full_jid))
 
     def set_creds(self, short_jid, un, pw):
+        rec = self.sleeping.get(short_jid)
+        if rec:
+            rec.username = un
+            rec.password = pw
+            return
         u=self.users.get(short_jid)
         if u:
             u.username = un
@@ -310,7 +817,85 @@ class UserRegistry(object):
         else:
             log.msg("Couldn't find %s to set creds" % short_jid)
 
+    def _wake(self, short_jid, stuff=None):
+        rec = self.sleeping.pop(short_jid, None)
+        if rec is None:
+            return self.users.get(short_jid)
+        presence_log.debug("Waking %s", short_jid)
+        if stuff is None:
+            stuff = rec.expand()
+        self.users[short_jid] = stuff
+        if stuff.username and stuff.password and not stuff.loop:
+            stuff.start()
+        return stuff
+
+    def touch(self, short_jid):
+        u = self._wake(short_jid)
+        if u:
+            u.touch()
+
+    def delivered(self, stuff):
+        """Note a private delivery, waking the user if need be."""
+        stuff.active()
+        if stuff.short_jid in self.sleeping:
+            self._wake(stuff.short_jid, stuff)
+
+    def hibernate(self, now=None):
+        """Put users idle for HIBERNATE_AFTER to sleep."""
+        if not HIBERNATE_AFTER:
+            return
+        cutoff = (now or time.time()) - HIBERNATE_AFTER
+        n = 0
+        for short_jid, u in self.users.items():
+            if u.active_at < cutoff:
+                u.stop()
+                self.sleeping[short_jid] = Hibernating(u)
+                del self.users[short_jid]
+                n += 1
+        if n:
+            presence_log.info("%d users hibernating, %d newly",
+                              len(self.sleeping), n)
+
+    def _check_sleeping(self, slice, limit):
+        recs = [rec for rec in self.sleeping.values()
+                if rec.username and rec.password
+                and _sleep_slice(rec.short_jid) == slice]
+        if len(recs) > limit:
+            # Over budget;  who waits for another hour is left to chance.
+            presence_log.info("Checking %d of %d sleeping users",
+                              limit, len(recs))
+            recs = random.sample(recs, limit)
+        for rec in recs:
+            if rec.short_jid not in self.sleeping:
+                continue
+            # A throwaway poller;  it's kept if it finds anything.
+            rec.expand()()
+            yield None
+
+    def check(self):
+        """Look for news for the next slice of sleeping users.
+
+        Once per round of slices, idle users are hibernated first."""
+        slice = self.slice
+        self.slice = (slice + 1) % SLEEP_SLICES
+        if slice == 0:
+            self.hibernate()
+        if self.sleeping and not self.checking:
+            def done(x):
+                self.checking = None
+                return x
+            self.checking = task.coiterate(
+                self._check_sleeping(slice, _sleeper_budget())
+                ).addBoth(done
+                ).addErrback(log.err)
+
     def remove(self, short_jid, full_jid=None):
+        rec = self.sleeping.get(short_jid)
+        if rec:
+            rec.jids = tuple(j for j in rec.jids if j != full_jid)
+            if not rec.jids:
+                del self.sleeping[short_jid]
+            return
         q = self.users.get(short_jid)
         if not q:
             return
@@ -321,24 +906,443 @@ class UserRegistry(object):
 
 queries = QueryRegistry()
 users = UserRegistry()
+renderer = rendering.Renderer(config.getint('general', 'render_workers', 0))
+status_cache = rendering.StatusCache(
+    config.getint('general', 'status_cache_mb', 16) << 20)
+
+metrics.registry.gauge('twitterspy_status_cache_bytes',
+                       'Approximate size of the rendered status cache.',
+                       lambda: status_cache.bytes)
+metrics.registry.gauge('twitterspy_status_cache_hit_ratio',
+                       'Timeline statuses found already rendered.',
+                       lambda: float(status_cache.hits)
+                           / max(status_cache.hits + status_cache.misses, 1))
+
+for _l in (search_limiter, private_limiter, available_limiter):
+    metrics.registry.gauge('twitterspy_%s_concurrency' % _l.name,
+                           'Concurrent %s calls allowed.' % _l.name,
+                           lambda l=_l: l.limit)
+    metrics.registry.gauge('twitterspy_%s_waiting' % _l.name,
+                           '%s calls waiting to start.' % _l.name.capitalize(),
+                           lambda l=_l: len(l))
+
+metrics.registry.gauge('twitterspy_queries', 'Queries being tracked.',
+                       lambda: len(queries.queries))
+metrics.registry.gauge('twitterspy_users', 'Users with available resources.',
+                       lambda: len(users))
+metrics.registry.gauge('twitterspy_hibernating_users',
+                       'Idle users kept as compact records.',
+                       lambda: len(users.sleeping))
+metrics.registry.gauge('twitterspy_available_requests',
+                       'Twitter API requests left this period.',
+                       lambda: available_requests)
+metrics.registry.gauge('twitterspy_private_requests_per_user',
+                       'Private API requests so far, averaged over users.',
+                       lambda: (float(private_requests.total())
+                                / max(len(users), 1)))
+metrics.registry.gauge('twitterspy_shared_timelines',
+                       'Friend timeline fetches shared between JIDs.',
+                       lambda: shared_timelines.shared)
+
+class CircuitBreaker(object):
+    """Stop polling tracks while the search API is failing.
+
+    While closed, polls go out as scheduled.  When fewer than open_below of
+    the last searches worked, the breaker opens and polls are shed.  After a
+    jittered back-off it goes half-open and lets a few probe searches
+    through; if they all work it closes, otherwise it opens again for twice
+    as long.  On closing, the shed queries are polled a few at a time, the
+    most watched first."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    open_below = 0.5
+    min_calls = 20
+    base_delay = 30
+    max_delay = 30 * 60
+    probes = 3
+    # Shed queries polled per second after closing.
+    catchup_rate = 5
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.delay = self.base_delay
+        self.recent = moodiness.Window()
+        # query string -> Query
+        self.shed = {}
+        self.probing = 0
+        self.probed = 0
+        self.catchup = None
+
+    def _transition(self, state):
+        log.msg("Search circuit breaker is now %s" % state)
+        self.state = state
+        self.recent = moodiness.Window()
+        self.probing = 0
+        self.probed = 0
+
+    def _open(self):
+        self._transition(self.OPEN)
+        delay = self.delay * random.uniform(0.5, 1.5)
+        self.delay = min(self.delay * 2, self.max_delay)
+        reactor.callLater(delay, self._transition, self.HALF_OPEN)
+
+    def _close(self):
+        self._transition(self.CLOSED)
+        self.delay = self.base_delay
+        pending = sorted(self.shed.values(), key=len, reverse=True)
+        self.shed = {}
+        if pending and not self.catchup:
+            self.catchup = task.cooperate(self._catch_up(pending))
+
+    def _catch_up(self, pending):
+        for i, q in enumerate(pending):
+            if self.state != self.CLOSED:
+                self.shed.update((p.query, p) for p in pending[i:])
+                break
+            if q.loop and queries.queries.get(q.query) is q:
+                q()
+            if i % self.catchup_rate == self.catchup_rate - 1:
+                d = defer.Deferred()
+                reactor.callLater(1, d.callback, None)
+                yield d
+        self.catchup = None
+
+    def allow(self, query):
+        """May this query poll now?"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and self.probing < self.probes:
+            self.probing += 1
+            return True
+        self.shed[query.query] = query
+        shed_polls.inc()
+        return False
+
+    def succeeded(self, x):
+        self.recent.add(moodiness.OK)
+        if self.state == self.HALF_OPEN:
+            self.probed += 1
+            if self.probed >= self.probes:
+                self._close()
+        return x
+
+    def failed(self, e):
+        self.recent.add(moodiness.OTHER)
+        if self.state == self.HALF_OPEN:
+            self._open()
+        elif self.state == self.CLOSED:
+            counts, total = self.recent.counts()
+            if (total >= self.min_calls and
+                counts.get(moodiness.OK, 0) < self.open_below * total):
+                self._open()
+        return e
+
+breaker = CircuitBreaker()
+
+shed_polls = metrics.registry.counter('twitterspy_shed_polls_total',
+    'Track polls skipped while the search circuit breaker was open.')
+metrics.registry.gauge('twitterspy_breaker_open',
+                       'Whether the search circuit breaker is open '
+                       '(0 closed, 1 half-open, 2 open).',
+                       lambda: [breaker.CLOSED, breaker.HALF_OPEN,
+                                breaker.OPEN].index(breaker.state))
+
+class _StreamUser(object):
+    def __init__(self, screen_name):
+        self.screen_name = screen_name
+
+class _StreamStatus(object):
+    """A status read from a replay file."""
+
+    def __init__(self, d):
+        self.id = d['id']
+        self.text = d['text']
+        self.user = _StreamUser(d['user']['screen_name'])
+
+class _TrackStream(object):
+    """A connection to the filtered track stream, which can be closed."""
+
+    url = config.get('stream', 'url',
+                     'http://stream.twitter.com/1/statuses/filter.xml')
+
+    def __init__(self, terms, delegate):
+        track = ','.join(t.encode('utf-8') for t in sorted(terms))
+        auth = base64.b64encode('%s:%s' % (config.get('stream', 'user'),
+                                           config.get('stream', 'pass')))
+        self.factory = webclient.HTTPDownloader(
+            self.url + '?' + urllib.urlencode({'track': track}),
+            txml.HoseFeed(delegate),
+            headers={'Authorization': 'Basic ' + auth}, agent='twitterspy')
+        self.connector = reactor.connectTCP(self.factory.host,
+                                            self.factory.port, self.factory)
+        self.deferred = self.factory.deferred
+
+    def close(self):
+        self.connector.disconnect()
+
+class Firehose(object):
+    """Feed tracks from a single shared stream of statuses.
+
+    In stream mode the filtered track stream is asked for the words of every
+    query the matcher can evaluate (the most watched first, up to
+    max_terms), and each status it sends is matched locally against those
+    queries.  Queries the running stream (or replay) feeds need no searches
+    of their own;  the rest, and all of them while the stream is down, keep
+    polling, and pick up from the last streamed status when they do.
+
+    Twitter bans clients that reconnect too often, so the stream is only
+    replaced for new terms every min_reconnect (queries it doesn't cover
+    poll meanwhile), the old one is closed first, and a lost stream is
+    retried with exponential backoff."""
+
+    # Don't recompile the matcher more often than this.
+    rebuild_interval = 30
+    # Statuses per second read from a replay file.
+    replay_rate = 50
+    # Twitter's limits on track terms per stream, and bytes per term.
+    max_terms = 400
+    max_term_bytes = 60
+    # Don't reconnect for changed terms more often than this.
+    min_reconnect = 5 * 60
+    # Wait this long before reconnecting a lost stream, doubling with each
+    # failure in a row up to max_retry_delay.
+    retry_delay = 30
+    max_retry_delay = 15 * 60
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.matcher = matcher.Matcher()
+        self.registry = None
+        self.generation = None
+        self.received = 0
+        self.matched = 0
+        self.loop = None
+        self.rebuilder = None
+        # Queries being fed, and the terms the stream was asked for.
+        self.feeding = frozenset()
+        self.streamed_terms = None
+        # Bumped on each connect, so a replaced stream ending is ignored.
+        self.connection = 0
+        self.stream = None
+        self.connected_at = None
+        # Streams lost in a row, and the pending retry after the last.
+        self.failures = 0
+        self.retry_call = None
+        # canonical query -> its stream terms, or None if it has none
+        self.terms = {}
+        # Queries (by canonical form) with streamed results not yet saved.
+        self.unsaved = set()
+
+    @property
+    def active(self):
+        return self.mode != 'poll'
+
+    def covers(self, query):
+        """Is the stream feeding this query right now?"""
+        return query in self.feeding
+
+    def _terms(self, query):
+        try:
+            return self.terms[query]
+        except KeyError:
+            pass
+        rv = None
+        try:
+            clauses = matcher.compile_query(query)
+        except matcher.Unmatchable:
+            clauses = []
+        if clauses:
+            # The track stream ANDs the words of a term, ignoring order and
+            # hashtags;  phrases and exclusions are checked locally.
+            rv = []
+            for req, exc in clauses:
+                ws = [w.lstrip('#@') for term in req for w in term]
+                if [w for w in ws if ':' in w]:
+                    # from: would need the follow stream.
+                    rv = None
+                    break
+                t = ' '.join(ws)
+                if len(t) > self.max_term_bytes:
+                    rv = None
+                    break
+                rv.append(t)
+            if rv is not None:
+                rv = tuple(rv)
+        self.terms[query] = rv
+        return rv
+
+    def _choose(self):
+        """Pick the queries to feed, and the stream terms they need."""
+        running = queries.queries
+        for k in list(self.terms):
+            if k not in running:
+                del self.terms[k]
+        chosen = []
+        terms = set()
+        for q in sorted(running.values(), key=len, reverse=True):
+            t = self._terms(q.query)
+            if t is None:
+                continue
+            if self.mode == 'stream':
+                if len(terms | set(t)) > self.max_terms:
+                    continue
+                terms.update(t)
+            chosen.append(q.query)
+        return frozenset(chosen), frozenset(terms)
+
+    def _rebuild(self):
+        self._save_cursors()
+        if (self.registry is queries
+            and self.generation == queries.generation):
+            return
+        self.registry = queries
+        self.generation = queries.generation
+        chosen, terms = self._choose()
+        if self.mode == 'stream' and terms != self.streamed_terms:
+            if self._may_connect():
+                self._connect(terms)
+            else:
+                # Keep the stream we have, feed what it covers and look
+                # again on the next rebuild.
+                streamed = self.streamed_terms or frozenset()
+                chosen = frozenset(q for q in chosen
+                                   if streamed.issuperset(self.terms[q]))
+                self.generation = None
+        if self.mode == 'stream' or self.loop:
+            self._feed(chosen)
+
+    def _may_connect(self):
+        if self.retry_call is not None:
+            return False
+        return (self.connected_at is None
+                or reactor.seconds() - self.connected_at >= self.min_reconnect)
+
+    def _feed(self, chosen):
+        if chosen == self.feeding:
+            return
+        self.matcher = matcher.Matcher(chosen)
+        self.feeding = chosen
+        log.msg("Feeding %d of %d queries from the stream"
+                % (len(chosen), len(queries.queries)))
+
+    def _save_cursors(self):
+        for query_str in self.unsaved:
+            q = queries.queries.get(query_str)
+            if q:
+                threads.deferToThread(q._deferred_write, q.last_id)
+        self.unsaved.clear()
+
+    def ingest(self, status, connection=None):
+        if not protocol.current_conn:
+            return
+        if connection is not None:
+            if connection != self.connection:
+                return
+            # It's working again.
+            self.failures = 0
+        self.received += 1
+        for query_str in self.matcher.match(status.text,
+                                            status.user.screen_name):
+            q = queries.queries.get(query_str)
+            if q:
+                self.matched += 1
+                q.streamed(status)
+                self.unsaved.add(query_str)
+
+    def _close(self):
+        if self.stream:
+            stream, self.stream = self.stream, None
+            stream.close()
+
+    def _connect(self, terms):
+        self._close()
+        self.connection += 1
+        self.streamed_terms = terms
+        if not terms:
+            return
+        connection = self.connection
+        self.connected_at = reactor.seconds()
+        log.msg("Connecting to the track stream for %d terms" % len(terms))
+        self.stream = _TrackStream(terms, lambda s: self.ingest(s, connection))
+        self.stream.deferred.addBoth(self._stream_lost, connection)
+
+    def _stream_lost(self, e, connection):
+        if connection != self.connection:
+            # Closed for a stream for newer terms.
+            return
+        self.stream = None
+        self.failures += 1
+        delay = min(self.retry_delay * 2 ** (self.failures - 1),
+                    self.max_retry_delay)
+        log.msg("Lost the status stream (%s), retrying in %ds"
+                % (str(e), delay))
+        # Everything polls until it's back.
+        self.connection += 1
+        self.streamed_terms = None
+        self._feed(frozenset())
+        self.retry_call = reactor.callLater(delay, self._reconnect)
+
+    def _reconnect(self):
+        self.retry_call = None
+        self.connected_at = None
+        self.generation = None
+        self._rebuild()
+
+    def _replay(self, f):
+        for i in range(self.replay_rate):
+            line = f.readline()
+            if not line:
+                log.msg("Finished replaying statuses.")
+                self.loop.stop()
+                self.loop = None
+                self._save_cursors()
+                self._feed(frozenset())
+                return
+            if line.strip():
+                self.ingest(_StreamStatus(json.loads(line)))
+
+    def start(self):
+        if self.mode.startswith('replay:'):
+            self.loop = task.LoopingCall(self._replay, open(self.mode[7:]))
+            self.loop.start(1)
+        self.rebuilder = task.LoopingCall(self._rebuild)
+        self.rebuilder.start(self.rebuild_interval)
+
+firehose = Firehose(config.INGEST)
+
+metrics.registry.gauge('twitterspy_stream_received',
+                       'Statuses received from the stream.',
+                       lambda: firehose.received)
+metrics.registry.gauge('twitterspy_stream_matched',
+                       'Track matches found in the stream.',
+                       lambda: firehose.matched)
+metrics.registry.gauge('twitterspy_stream_queries',
+                       'Queries fed by the stream instead of polling.',
+                       lambda: len(firehose.feeding))
 
 def _entity_to_jid(entity):
     return entity if isinstance(entity, basestring) else entity.userhost()
 
 @models.wants_session
 def _load_user(entity, session):
-    u = models.User.update_status(_entity_to_jid(entity), None, session)
-    rv = None
-    if u.active:
-        tracks = [(t.query, t.max_seen) for t in u.tracks]
-        rv = ((u.username, u.decoded_password,
-            u.friend_timeline_id, u.direct_message_id), tracks)
-    return rv
-
-def _init_user(stuff, short_jid, full_jids):
+    return models.User.polling_state(_entity_to_jid(entity), session)
+
+def _init_user(stuff, short_jid, full_jids, expected=()):
+    if expected:
+        # Undo anything the snapshot guessed wrong.
+        tracked = set()
+        if stuff:
+            tracked = set(canonical.canonicalize(q) for q, id in stuff[1])
+        for j in full_jids:
+            for q in expected:
+                if q not in tracked:
+                    queries.untracked(j, q)
     if stuff:
         for j in full_jids:
-            users.add(short_jid, j, stuff[0][2], stuff[0][3])
+            users.add(short_jid, j, stuff[0][2], stuff[0][3], stuff[0][4])
             for q, id in stuff[1]:
                 queries.add(j, q, id)
         users.set_creds(short_jid, stuff[0][0], stuff[0][1])
@@ -346,29 +1350,43 @@ def _init_user(stuff, short_jid, full_jids):
 def enable_user(jid):
     def process():
         return threads.deferToThread(_load_user, jid).addCallback(
-            _init_user, jid, users.users.get(jid, []))
-    global available_sem
-    available_sem.run(process)
+            _init_user, jid, presence.full_jids(jid))
+    metrics.run_timed(available_limiter, 'available', process)
 
 def disable_user(jid):
-    queries.remove_user(jid, users.users.get(jid, []))
+    queries.remove_user(jid, presence.full_jids(jid))
     users.set_creds(jid, None, None)
 
+def reload_user(jid):
+    """Pick up changes to a user's tracks or settings."""
+    disable_user(jid)
+    enable_user(jid)
+
 def available_user(entity):
+    if not sharding.settled():
+        # Picked up from the presence table once it has.
+        return
+    # Put the resource back where it was before a restart right away, the
+    # database will catch up.
+    expected = snapshot.expected.get(entity.userhost(), ())
+    for q in expected:
+        queries.add(entity.full(), q, 0)
     def process():
         return threads.deferToThread(_load_user, entity).addCallback(
-            _init_user, entity.userhost(), [entity.full()])
-    global available_sem
-    available_sem.run(process)
+            _init_user, entity.userhost(), [entity.full()], expected)
+    metrics.run_timed(available_limiter, 'available', process)
 
 def unavailable_user(entity):
     queries.remove(entity.full())
     users.remove(entity.userhost(), entity.full())
 
 def resources(jid):
-    """Find all watched resources for the given JID."""
-    jids=users.users.get(jid, [])
-    return [JID(j).resource for j in jids]
+    """Find all resources of the given JID that get messages."""
+    return presence.resources(jid)
+
+def checkSleepers():
+    """Called every HIBERNATE_CHECK / SLEEP_SLICES."""
+    users.check()
 
 def _reset_all():
     global queries
@@ -382,8 +1400,25 @@ def _reset_all():
     queries = QueryRegistry()
     users = UserRegistry()
 
+def rebalance():
+    """Drop what this worker no longer owns and pick up what it now does."""
+    _reset_all()
+    for e in presence.entities():
+        available_user(e)
+
+def _take_over():
+    """Take on this worker's share once sharding has settled."""
+    snapshot.restore()
+    for e in presence.entities():
+        available_user(e)
+
 def connected():
     _reset_all()
+    presence.clear()
+    sharding.reset()
+    sharding.when_settled(_take_over)
 
 def disconnected():
+    snapshot.save()
     _reset_all()
+    presence.clear()
@@ -0,0 +1,258 @@
+"""
+Splitting tracks and users between several twitterspy workers.
+
+Each worker logs in to the same XMPP account with its own resource (the
+[shard] name) and sees the others come and go through the account's own
+presence.  Queries (by canonical form) and users (by bare JID) are assigned
+to workers by consistent hashing, so when a worker joins or leaves only its
+share moves.  Each worker polls, delivers and spends API requests for what
+it owns.
+
+After (re)connecting, a worker owns nothing until SETTLE_DELAY has passed,
+so the presence of the other workers has arrived first and no two workers
+take on the same work.  Commands sent to the bare JID may be copied to
+every worker or delivered to just one of them, so workers forward them to
+the user's owner, which answers each one once.
+"""
+
+import time
+import bisect
+import hashlib
+from collections import deque
+
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.words.xish import domish
+from twisted.words.protocols.jabber.jid import JID
+
+import config
+import protocol
+import scheduling
+
+NAME = config.get('shard', 'name')
+
+# Wait for membership to settle this long before rebalancing.
+REBALANCE_DELAY = 5
+# And this long after connecting before taking on any work.
+SETTLE_DELAY = 10
+
+SYNC = 'shard_sync'
+FORWARD = 'shard_forward'
+
+# Commands are remembered by sender and stanza id for this long, so one
+# that reaches its owner both directly and forwarded is answered once.
+SEEN_FOR = 60
+
+class HashRing(object):
+    """A consistent hash ring of worker names."""
+
+    replicas = 64
+
+    def __init__(self, nodes=()):
+        self.nodes = set()
+        self.ring = []
+        for n in nodes:
+            self.add(n)
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def add(self, node):
+        if node in self.nodes:
+            return False
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            bisect.insort(self.ring, (self._hash('%s-%d' % (node, i)), node))
+        return True
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return False
+        self.nodes.discard(node)
+        self.ring = [e for e in self.ring if e[1] != node]
+        return True
+
+    def owner(self, key):
+        if not self.ring:
+            return None
+        i = bisect.bisect(self.ring, (self._hash(key),))
+        return self.ring[i % len(self.ring)][1]
+
+ring = HashRing([NAME] if NAME else [])
+_rebalance_call = None
+_settle_call = None
+_settled = True
+# (f, args) to run once settled
+_pending = []
+# (sender, stanza id) -> when seen, and (when, key) oldest first
+_seen = {}
+_seen_order = deque()
+
+def enabled():
+    return NAME is not None
+
+def settled():
+    """Has this worker taken on its share since connecting?"""
+    return _settled
+
+def owns(key):
+    """Is this worker responsible for the given query or bare JID?"""
+    return NAME is None or (_settled and ring.owner(key) == NAME)
+
+def _first_sight(sender, stanza_id, now=None):
+    """Is this the first time this worker has seen the command?
+
+    Commands without an id can't be told apart, so they always are."""
+    if not stanza_id:
+        return True
+    now = now or time.time()
+    while _seen_order and _seen_order[0][0] < now - SEEN_FOR:
+        t, k = _seen_order.popleft()
+        if _seen.get(k) == t:
+            del _seen[k]
+    key = (sender, stanza_id)
+    if key in _seen:
+        return False
+    _seen[key] = now
+    _seen_order.append((now, key))
+    return True
+
+def answers(msg):
+    """Should this worker answer a message from a user?
+
+    Anything sent to this worker's own resource is answered here.  Anything
+    sent to the bare JID is answered by the sender's owner;  other workers
+    forward it there, as the server may have given it to them alone."""
+    if NAME is None:
+        return True
+    to = msg.getAttribute('to')
+    if to and JID(to).resource == NAME:
+        return True
+    sender = msg['from']
+    owner = ring.owner(JID(sender).userhost())
+    if owner != NAME:
+        _forward(owner, sender, msg.getAttribute('id'), unicode(msg.body))
+        return False
+    return _first_sight(sender, msg.getAttribute('id'))
+
+def when_settled(f, *args):
+    """Call f now, or once this worker has taken on its share."""
+    if _settled:
+        f(*args)
+    else:
+        _pending.append((f, args))
+
+def reset():
+    """Start over after connecting, with only this worker in the ring.
+
+    Peers that went away while we were disconnected would otherwise keep
+    their share, and nobody would do it.  Until SETTLE_DELAY has passed,
+    this worker owns nothing."""
+    global ring, _rebalance_call, _settle_call, _settled
+    ring = HashRing([NAME] if NAME else [])
+    for call in (_rebalance_call, _settle_call):
+        if call and call.active():
+            call.cancel()
+    _rebalance_call = None
+    _settle_call = None
+    del _pending[:]
+    if enabled():
+        _settled = False
+        _settle_call = reactor.callLater(SETTLE_DELAY, _settle)
+
+def _settle():
+    global _rebalance_call, _settle_call, _settled
+    _settle_call = None
+    _settled = True
+    # Taking over goes by the ring as it is now anyway.
+    if _rebalance_call and _rebalance_call.active():
+        _rebalance_call.cancel()
+    _rebalance_call = None
+    log.msg("Settled with workers: %s" % sorted(ring.nodes))
+    pending = _pending[:]
+    del _pending[:]
+    for f, args in pending:
+        try:
+            f(*args)
+        except:
+            log.err()
+
+def worker_jid():
+    """The JID this worker logs in as."""
+    j = JID(config.SCREEN_NAME)
+    if NAME:
+        j = JID(tuple=(j.user, j.host, NAME))
+    return j
+
+def is_peer(entity):
+    return (NAME is not None
+            and entity.userhost() == JID(config.SCREEN_NAME).userhost())
+
+def _schedule_rebalance():
+    global _rebalance_call
+    if _rebalance_call and _rebalance_call.active():
+        _rebalance_call.reset(REBALANCE_DELAY)
+    else:
+        _rebalance_call = reactor.callLater(REBALANCE_DELAY, _rebalance)
+
+def _rebalance():
+    global _rebalance_call
+    _rebalance_call = None
+    if not _settled:
+        # Everything is picked up when it settles.
+        return
+    log.msg("Rebalancing across workers: %s" % sorted(ring.nodes))
+    scheduling.rebalance()
+
+def peer_available(resource):
+    if ring.add(resource):
+        log.msg("Worker %s joined" % resource)
+        _schedule_rebalance()
+
+def peer_unavailable(resource):
+    if resource != NAME and ring.remove(resource):
+        log.msg("Worker %s left" % resource)
+        _schedule_rebalance()
+
+def _send_peer(peer, body):
+    if protocol.current_conn:
+        bare = JID(config.SCREEN_NAME).userhost()
+        protocol.current_conn.send_peer(bare + '/' + peer, body)
+
+def user_changed(jid):
+    """Tell the other workers a user's tracks or settings changed."""
+    if not enabled():
+        return
+    for peer in ring.nodes:
+        if peer != NAME:
+            _send_peer(peer, SYNC + ' ' + jid)
+
+def _forward(peer, sender, stanza_id, body):
+    """Pass a user's command on to the worker that owns the user."""
+    _send_peer(peer, u' '.join([FORWARD, sender, stanza_id or '-', body]))
+
+def _answer_forwarded(sender, stanza_id, body):
+    if not _first_sight(sender, stanza_id) or not protocol.current_conn:
+        return
+    msg = domish.Element((None, 'message'))
+    msg['from'] = sender
+    msg['to'] = worker_jid().full()
+    msg['type'] = 'chat'
+    if stanza_id:
+        msg['id'] = stanza_id
+    msg.addElement('body', content=body)
+    protocol.current_conn.answer(msg)
+
+def peer_message(body):
+    a = body.strip().split(None, 1)
+    if len(a) == 2 and a[0] == SYNC:
+        scheduling.reload_user(a[1])
+    elif len(a) == 2 and a[0] == FORWARD and len(a[1].split(None, 2)) == 3:
+        sender, stanza_id, text = a[1].split(None, 2)
+        if stanza_id == '-':
+            stanza_id = None
+        when_settled(_answer_forwarded, sender, stanza_id, text)
+    else:
+        log.msg("Unknown message from a peer: %s" % body)
@@ -0,0 +1,101 @@
+"""
+Leveled, sampled and rate limited logging for hot paths.
+
+Each category has a level, a sample rate and a maximum number of messages
+per second, set in the [logging] section of the config:
+
+    [logging]
+    level: info
+    delivery: debug
+    delivery.sample: 0.01
+    delivery.rate: 20
+
+Messages are only formatted once they're known to be written, so a
+disabled debug call costs a method call and a comparison.  Keyword
+arguments are passed through to twisted's log as event fields.
+"""
+
+import time
+import random
+
+from twisted.python import log
+
+import config
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warn': WARN, 'error': ERROR}
+
+def _setting(option, default=None):
+    return config.get('logging', option, default)
+
+class Category(object):
+
+    def __init__(self, name, level=None, sample=None, rate=None):
+        self.name = name
+        if level is None:
+            level = LEVELS[_setting(name, _setting('level', 'info')).lower()]
+        if sample is None:
+            sample = float(_setting(name + '.sample', 1))
+        if rate is None:
+            rate = _setting(name + '.rate')
+            rate = rate and float(rate)
+        self.level = level
+        self.sample = sample
+        self.rate = rate
+        self.tokens = rate
+        self.refilled = time.time()
+        self.suppressed = 0
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def _allowed(self):
+        if self.sample < 1 and random.random() >= self.sample:
+            return False
+        if self.rate:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+        return True
+
+    def log(self, level, fmt, *args, **fields):
+        if level < self.level or not self._allowed():
+            return
+        msg = fmt % args if args else fmt
+        if self.suppressed:
+            msg += " (%d similar messages suppressed)" % self.suppressed
+            self.suppressed = 0
+        log.msg("[%s] %s" % (self.name, msg), category=self.name,
+                level=level, **fields)
+
+    def debug(self, fmt, *args, **fields):
+        if DEBUG >= self.level:
+            self.log(DEBUG, fmt, *args, **fields)
+
+    def info(self, fmt, *args, **fields):
+        if INFO >= self.level:
+            self.log(INFO, fmt, *args, **fields)
+
+    def warn(self, fmt, *args, **fields):
+        self.log(WARN, fmt, *args, **fields)
+
+    def error(self, fmt, *args, **fields):
+        self.log(ERROR, fmt, *args, **fields)
+
+_categories = {}
+
+def category(name):
+    """Get the logger for the named category."""
+    c = _categories.get(name)
+    if c is None:
+        c = _categories[name] = Category(name)
+    return c
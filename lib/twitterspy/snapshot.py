@@ -0,0 +1,123 @@
+"""
+Snapshots of the scheduler's state, for a quick restart.
+
+The running queries, their cursors, when each is next due and who was
+watching are written to a local file every so often and when the XMPP
+connection goes away.  After (re)connecting, the queries are recreated
+from it right away with their old cursors and due times, and watchers are
+put back as soon as their presence arrives instead of waiting for the
+database.  A restored query doesn't poll until its watchers are all back
+(or PRESENCE_GRACE has passed), so what was posted while we were away
+isn't fetched with nobody there to get it.
+"""
+
+import os
+import time
+import marshal
+
+from twisted.python import log
+from twisted.internet import reactor, threads
+
+import config
+import sharding
+import scheduling
+
+FORMAT = 1
+
+PATH = config.get('general', 'snapshot')
+
+# Restored queries nobody has claimed after this long are dropped.
+GRACE = 10 * 60
+
+# Overdue queries are spread out to start at about this many per second.
+CATCHUP_RATE = 20
+
+# Restored queries wait this long at most for their watchers to come back.
+PRESENCE_GRACE = 30
+
+# bare jid -> [canonical query] from the last restored snapshot
+expected = {}
+
+def _write(path, data):
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+        marshal.dump(data, f)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+def save(path=PATH):
+    """Write the scheduler's state.  Returns a Deferred, or None if off."""
+    if not path or not scheduling.queries.queries:
+        return None
+    now = reactor.seconds()
+    saved = []
+    for q in scheduling.queries.queries.values():
+        due = q.next_due()
+        saved.append((q.query, q.last_id, due - now if due else None,
+                      list(set(j.split('/', 1)[0] for j in q))))
+    data = {'format': FORMAT, 'saved': time.time(), 'queries': saved}
+    log.msg("Saving a snapshot of %d queries" % len(saved))
+    return threads.deferToThread(_write, path, data).addErrback(log.err)
+
+def _load(path):
+    f = open(path, 'rb')
+    try:
+        data = marshal.load(f)
+    finally:
+        f.close()
+    if data.get('format') != FORMAT:
+        raise ValueError("Unknown snapshot format: %r" % data.get('format'))
+    return data
+
+def restore(path=PATH):
+    """Pre-warm the scheduler from the last snapshot."""
+    expected.clear()
+    if not path or not os.path.exists(path):
+        return
+    try:
+        data = _load(path)
+    except Exception:
+        log.err()
+        return
+    elapsed = time.time() - data['saved']
+    overdue = 0
+    restored = 0
+    for query, last_id, due, watchers in data['queries']:
+        if not sharding.owns(query) or query in scheduling.queries.queries:
+            continue
+        if due is None or due - elapsed < 1:
+            overdue += 1
+            then = 1 + overdue / float(CATCHUP_RATE)
+        else:
+            then = due - elapsed
+        q = scheduling.Query(query, last_id, then)
+        q.hold(watchers)
+        scheduling.queries.queries[query] = q
+        scheduling.queries.generation += 1
+        restored += 1
+        for w in watchers:
+            expected.setdefault(w, []).append(query)
+    log.msg("Restored %d queries (%d overdue) from a %ds old snapshot"
+            % (restored, overdue, elapsed))
+    reactor.callLater(PRESENCE_GRACE, _release, scheduling.queries)
+    reactor.callLater(GRACE, _expire, scheduling.queries)
+
+def _release(registry):
+    """Let restored queries poll, whoever's back."""
+    if registry is not scheduling.queries:
+        return
+    for q in registry.queries.values():
+        q.release()
+
+def _expire(registry):
+    """Drop restored queries that never got a watcher back."""
+    expected.clear()
+    if registry is not scheduling.queries:
+        return
+    for k, q in registry.queries.items():
+        if not q:
+            q.stop()
+            del registry.queries[k]
+            registry.generation += 1
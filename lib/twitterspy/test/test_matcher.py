@@ -0,0 +1,83 @@
+"""
+Tests for the local track matcher.
+
+Run from lib:  python -m unittest twitterspy.test.test_matcher
+(or trial twitterspy.test)
+"""
+
+import unittest
+
+from twitterspy import matcher
+
+class CompileTest(unittest.TestCase):
+
+    def assertUnmatchable(self, query):
+        self.assertRaises(matcher.Unmatchable, matcher.compile_query, query)
+
+    def test_words(self):
+        self.assertEquals([((('python',), ('twisted',)), ())],
+                          matcher.compile_query('python twisted'))
+
+    def test_punctuation(self):
+        # Dropping the ++ would turn this into a search for "c".
+        self.assertUnmatchable('c++')
+        self.assertUnmatchable('e-mail')
+        self.assertUnmatchable('"hello, world"')
+
+    def test_tags(self):
+        self.assertEquals([((('#python',),), ())],
+                          matcher.compile_query('#python'))
+        self.assertUnmatchable('"#python rocks"')
+
+    def test_operators(self):
+        self.assertUnmatchable('python since:2009-01-01')
+        self.assertEquals([((('from:dustin',),), ())],
+                          matcher.compile_query('from:dustin'))
+
+class MatchTest(unittest.TestCase):
+
+    def match(self, queries, text, author=None):
+        return matcher.Matcher(queries).match(text, author)
+
+    def test_word(self):
+        self.assertEquals(set(['python']),
+                          self.match(['python'], 'I like Python.'))
+        self.assertEquals(set(), self.match(['python'], 'pythonic'))
+
+    def test_plain_word_matches_tag(self):
+        self.assertEquals(set(['python']),
+                          self.match(['python'], 'learning #python today'))
+        self.assertEquals(set(['python']),
+                          self.match(['python'], 'thanks @python'))
+
+    def test_tag_needs_tag(self):
+        self.assertEquals(set(['#python']),
+                          self.match(['#python'], 'learning #python today'))
+        self.assertEquals(set(), self.match(['#python'], 'learning python'))
+
+    def test_punctuation_not_matched(self):
+        m = matcher.Matcher(['c++', 'c'])
+        self.assertEquals(set(['c++']), m.unmatchable)
+        self.assertEquals(set(['c']), m.match('c is cool'))
+
+    def test_phrase(self):
+        q = '"big fish"'
+        self.assertEquals(set([q]), self.match([q], 'a big fish here'))
+        self.assertEquals(set([q]), self.match([q], 'a big #fish here'))
+        self.assertEquals(set(), self.match([q], 'a fish big here'))
+
+    def test_exclusion(self):
+        self.assertEquals(set(), self.match(['-snake python'],
+                                            'python the snake'))
+        self.assertEquals(set(['-snake python']),
+                          self.match(['-snake python'], 'python the language'))
+
+    def test_or(self):
+        q = 'python OR ruby'
+        self.assertEquals(set([q]), self.match([q], 'ruby gems'))
+        self.assertEquals(set(), self.match([q], 'perl modules'))
+
+    def test_from(self):
+        self.assertEquals(set(['from:dustin']),
+                          self.match(['from:dustin'], 'hello', 'Dustin'))
+        self.assertEquals(set(), self.match(['from:dustin'], 'hello', 'bob'))
@@ -0,0 +1,98 @@
+"""
+A watchdog for callbacks that block the reactor.
+
+A timer in the reactor records a heartbeat; a thread watches the heartbeat
+and, while it's overdue, samples the reactor thread's stack.  When the
+reactor comes back, the stall and the stack seen most often are reported
+to the admins and to metrics.
+"""
+
+from __future__ import with_statement
+
+import sys
+import time
+import thread
+import threading
+import traceback
+
+from twisted.application import service
+from twisted.internet import task
+from twisted.python import log
+
+import metrics
+import protocol
+import scheduling
+
+stalls = metrics.registry.counter('twitterspy_stalls_total',
+                                  'Times the reactor was blocked too long.')
+stall_seconds = metrics.registry.histogram('twitterspy_stall_seconds',
+                                           'How long the reactor was blocked.')
+
+class Watchdog(service.Service):
+
+    # Seconds between heartbeats and stack samples.
+    interval = 0.1
+    # Frames of each sampled stack to keep.
+    depth = 8
+    # Don't tell the admins more often than this.
+    report_interval = 300
+
+    def __init__(self, threshold=1.0):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.beat = None
+        self.reported_at = 0
+        self.loop = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.main_thread = thread.get_ident()
+        self.beat = time.time()
+        self.loop = task.LoopingCall(self._tick)
+        self.loop.start(self.interval)
+        t = threading.Thread(target=self._watch, name='watchdog')
+        t.setDaemon(True)
+        t.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.loop:
+            self.loop.stop()
+            self.loop = None
+
+    def _watch(self):
+        while self.running:
+            time.sleep(self.interval)
+            if time.time() - self.beat < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.main_thread)
+            if frame is None:
+                continue
+            stack = tuple(traceback.format_stack(frame)[-self.depth:])
+            with self.lock:
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def _tick(self):
+        now = time.time()
+        blocked = now - self.beat
+        self.beat = now
+        with self.lock:
+            samples, self.samples = self.samples, {}
+        if blocked >= self.threshold:
+            self._stalled(blocked, samples)
+
+    def _stalled(self, blocked, samples):
+        stalls.inc()
+        stall_seconds.observe(blocked)
+        msg = ["Reactor was blocked for %.2fs." % blocked]
+        if samples:
+            n, stack = max((n, s) for s, n in samples.items())
+            msg.append("Seen in %d of %d samples:" % (n, sum(samples.values())))
+            msg.append("".join(stack))
+        msg = "\n".join(msg)
+        log.msg(msg)
+        if (protocol.current_conn
+            and time.time() - self.reported_at > self.report_interval):
+            self.reported_at = time.time()
+            scheduling.admin_message(":-/ " + msg)
@@ -12,7 +12,7 @@ from twisted.python import log
 from twisted.words.xish import domish
 from twisted.words.protocols.jabber.jid import JID
 from twisted.web import client
-from twisted.internet import reactor, threads
+from twisted.internet import reactor, threads, task
 from wokkel import ping
 from sqlalchemy.orm import exc
 
@@ -21,10 +21,12 @@ import models
 import config
 import twitter
 import scheduling
+import sharding
 import protocol
 import moodiness
-
-all_commands={}
+import metrics
+import history
+import recent
 
 def arg_required(validator=lambda n: n):
     def f(orig):
@@ -102,6 +104,10 @@ class BaseStatusCommand(BaseCommand):
         rv.append("You are currently tracking %d topics." % len(user.tracks))
         if user.has_credentials:
             rv.append("You're logged in to twitter as %s" % (user.username))
+            stuff = scheduling.users.users.get(user.jid)
+            if stuff:
+                rv.append("I've made %d twitter requests for you "
+                    "since you logged in." % stuff.requests)
         if user.friend_timeline_id is not None:
             rv.append("Friend tracking is enabled.")
         return "\n".join(rv)
@@ -145,6 +151,7 @@ class OnCommand(BaseCommand):
     def __call__(self, user, prot, args, session):
         user.active=True
         scheduling.enable_user(user.jid)
+        sharding.user_changed(user.jid)
         prot.send_plain(user.jid, "Enabled tracks.")
 
 class OffCommand(BaseCommand):
@@ -154,26 +161,57 @@ class OffCommand(BaseCommand):
     def __call__(self, user, prot, args, session):
         user.active=False
         scheduling.disable_user(user.jid)
+        sharding.user_changed(user.jid)
         prot.send_plain(user.jid, "Disabled tracks.")
 
+class HistoryCommand(BaseCommand):
+
+    def __init__(self):
+        super(HistoryCommand, self).__init__('history',
+            'Show recent results already delivered for a topic.',
+            "history <topic> shows the last few results delivered for a "
+            "topic you or anyone else here tracks, without searching "
+            "twitter again.")
+
+    def _show(self, results, jid, prot, query):
+        if not results:
+            prot.send_plain(jid, "Nothing in the history for %s.  "
+                            "Try 'search %s'" % (query, query))
+            return
+        plain = [p for eid, t, p, h in results]
+        html = [h for eid, t, p, h in results]
+        prot.send_html(jid, "%d recent results for %s\n\n" % (
+                len(results), query) + "\n\n".join(plain),
+            "%d recent results for %s<br/>\n<br/>\n" % (len(results), query)
+                + "<br/>\n<br/>\n".join(html))
+
+    @arg_required()
+    def __call__(self, user, prot, args, session):
+        if not history.archive:
+            prot.send_plain(user.jid, "No history is kept here, sorry.")
+            return
+        history.archive.lookup(args).addCallback(
+            self._show, user.jid, prot, args).addErrback(log.err)
+
 class SearchCommand(BaseCommand):
 
     def __init__(self):
         super(SearchCommand, self).__init__('search',
             'Perform a search query (but do not track).')
 
-    def _success(self, e, jid, prot, query, rv):
+    def _success(self, e, jid, prot, query, rv, as_of=None):
         log.msg("%d results found for %s" % (len(rv.results), query))
         plain = []
         html = []
         for eid, p, h in rv.results:
             plain.append(p)
             html.append(h)
-        prot.send_html(jid, str(len(rv.results))
-                           + " results for " + query
-                           + "\n\n" + "\n\n".join(plain),
-                       str(len(rv.results)) + " results for "
-                           + query + "<br/>\n<br/>\n"
+        header = str(len(rv.results)) + " results for " + query
+        if as_of:
+            header += (" (from tracked results up to %d minutes old)"
+                       % ((time.time() - as_of) / 60))
+        prot.send_html(jid, header + "\n\n" + "\n\n".join(plain),
+                       header + "<br/>\n<br/>\n"
                            + "<br/>\n<br/>\n".join(html))
 
     def _error(self, e, jid, prot):
@@ -192,18 +230,34 @@ class SearchCommand(BaseCommand):
         prot.send_plain(jid, "\n".join(rv))
         return e
 
-    def _do_search(self, query, jid, prot):
+    def _do_search(self, query):
         rv = scheduling.SearchCollector()
-        scheduling.getTwitterAPI().search(query, rv.gotResult, {'rpp': '3'}
+        return scheduling.getTwitterAPI().search(query, rv.gotResult,
+                                                 {'rpp': '3'}
             ).addCallback(moodiness.moodiness.markSuccess
             ).addErrback(moodiness.moodiness.markFailure
-            ).addCallback(self._success, jid, prot, query, rv
-            ).addErrback(self._error, jid, prot
-            ).addErrback(log.err)
+            ).addCallback(lambda x: rv)
 
     @arg_required()
     def __call__(self, user, prot, args, session):
-        scheduling.search_semaphore.run(self._do_search, args, user.jid, prot)
+        local = recent.index.answer(args, 3)
+        if local:
+            rv = scheduling.SearchCollector()
+            rv.entries, as_of = local
+            rv.render().addCallback(self._success, user.jid, prot, args, rv,
+                                    as_of
+                ).addErrback(log.err)
+            return
+        # Only the search runs under the limiter;  rendering doesn't.
+        metrics.run_timed(
+            scheduling.search_limiter.prioritized(scheduling.INTERACTIVE),
+            'search', self._do_search, args
+            ).addCallback(self._render, user.jid, prot, args
+            ).addErrback(self._error, user.jid, prot
+            ).addErrback(log.err)
+
+    def _render(self, rv, jid, prot, query):
+        return rv.render().addCallback(self._success, jid, prot, query, rv)
 
 class TWLoginCommand(BaseCommand):
 
@@ -236,6 +290,7 @@ class TWLoginCommand(BaseCommand):
             prot.send_plain(user.jid, "Added credentials for %s"
                 % user.username)
             scheduling.users.set_creds(jid, username, password)
+            sharding.user_changed(jid)
         except:
             log.err()
             prot.send_plain(user.jid, "Error setting credentials for %s. "
@@ -252,6 +307,7 @@ class TWLogoutCommand(BaseCommand):
         user.password = None
         prot.send_plain(user.jid, "You have been logged out.")
         scheduling.users.set_creds(user.jid, None, None)
+        sharding.user_changed(user.jid)
 
 class TrackCommand(BaseCommand):
 
@@ -260,9 +316,13 @@ class TrackCommand(BaseCommand):
 
     @arg_required()
     def __call__(self, user, prot, args, session):
-        user.track(args, session)
+        if not user.track(args, session):
+            prot.send_plain(user.jid,
+                "There's nothing to search for in %s" % args)
+            return
         if user.active:
             scheduling.queries.add(user.jid, args, 0)
+            sharding.user_changed(user.jid)
             rv = "Tracking %s" % args
         else:
             rv = "Will track %s as soon as you activate again." % args
@@ -278,6 +338,7 @@ class UnTrackCommand(BaseCommand):
     def __call__(self, user, prot, args, session):
         if user.untrack(args, session):
             scheduling.queries.untracked(user.jid, args)
+            sharding.user_changed(user.jid)
             prot.send_plain(user.jid, "Stopped tracking %s" % args)
         else:
             prot.send_plain(user.jid,
@@ -291,7 +352,7 @@ class TracksCommand(BaseCommand):
 
     def __call__(self, user, prot, args, session):
         rv = ["Currently tracking:\n"]
-        rv.extend(sorted([t.query for t in user.tracks]))
+        rv.extend(sorted(user.track_names))
         prot.send_plain(user.jid, "\n".join(rv))
 
 class PostCommand(BaseCommand):
@@ -496,7 +557,7 @@ select t.query, count(*) as watchers
 """
         rv=["Top 10 most tracked topics:"]
         rv.append("")
-        for row in models._engine.execute(query).fetchall():
+        for row in models.read_engine().execute(query).fetchall():
             rv.append("%s (%d watchers)" % (row[0], row[1]))
         prot.send_plain(user.jid, "\n".join(rv))
 
@@ -517,6 +578,13 @@ class MoodCommand(BaseCommand):
         rv.append("I currently have %d API requests available, "
                   "and have run out %d times."
                   % (scheduling.available_requests, scheduling.empty_resets))
+        if user.is_admin:
+            npriv = scheduling.private_requests.total()
+            nusers = len(scheduling.users)
+            rv.append("Private requests: %d for %d users (%.1f each), "
+                      "%d friend timelines shared."
+                      % (npriv, nusers, float(npriv) / max(nusers, 1),
+                         scheduling.shared_timelines.shared))
         prot.send_plain(user.jid, "\n".join(rv))
 
 class AdminSubscribeCommand(BaseCommand):
@@ -581,36 +649,126 @@ class AdminPingCommand(BaseCommand):
                 j.resource=rsrc
                 self.ping(prot, user.jid, j.full())
 
+class AdminQueueCommand(BaseCommand):
+
+    def __init__(self):
+        super(AdminQueueCommand, self).__init__('adm_queue',
+            'Check the outbound message queue.')
+
+    @admin_required
+    def __call__(self, user, prot, args, session):
+        q = prot.outq
+        rv = ["Outbound queue: %d stanzas (%d recipients rate limited)"
+              % (q.depth, len(q.held))]
+        rv.append("Draining %.1f stanzas/s, %d sent total"
+                  % (q.drain_rate, q.sent))
+        if q.paused:
+            rv.append("Paused: the transport's buffer is full.")
+        prot.send_plain(user.jid, "\n".join(rv))
+
+class AdminStatsCommand(BaseCommand):
+
+    def __init__(self):
+        super(AdminStatsCommand, self).__init__('adm_stats',
+            'Show internal metrics.')
+
+    @admin_required
+    def __call__(self, user, prot, args, session):
+        rv = metrics.registry.summary()
+        if args:
+            rv = [l for l in rv if args.strip() in l]
+        prot.send_plain(user.jid, "\n".join(rv) or "No metrics yet.")
+
+def _next_chunk(chunks):
+    try:
+        return chunks.next()
+    except StopIteration:
+        return []
+
 class AdminBroadcastCommand(BaseCommand):
 
     def __init__(self):
         super(AdminBroadcastCommand, self).__init__('adm_broadcast',
                                                     'Broadcast a message.')
 
-    @models.wants_session
-    def _load_users(self, session):
-        return [user.jid for user in session.query(models.User).filter(
-                models.User.status.in_(['online', 'away', 'dnd', 'xa']))]
-
-    def _do_broadcast(self, users, prot, jid, msg):
-        log.msg("Administrative broadcast from %s" % jid)
-        for j in users:
-            log.msg("Sending message to %s" % j)
-            prot.send_plain(j, msg)
-        prot.send_plain(jid, "Sent message to %d users" % len(users))
+    def _broadcast(self, prot, jid, msg):
+        """Send to everyone a chunk of users at a time.
+
+        Chunks are read in a thread; sending yields to the reactor after
+        every message and waits whenever the outbound queue is full."""
+        chunks = models.iter_jids()
+        chunk = []
+        sent = 0
+        while True:
+            d = threads.deferToThread(_next_chunk, chunks)
+            d.addCallback(chunk.extend)
+            yield d
+            if not chunk:
+                break
+            for j in chunk:
+                prot.send_plain(j, msg)
+                sent += 1
+                if prot.outq.full:
+                    yield prot.outq.wait()
+                else:
+                    yield None
+            del chunk[:]
+        log.msg("Administrative broadcast from %s sent to %d users"
+                % (jid, sent))
+        prot.send_plain(jid, "Sent message to %d users" % sent)
 
     @admin_required
     @arg_required()
     def __call__(self, user, prot, args, session):
-        threads.deferToThread(self._load_users).addCallback(
-            self._do_broadcast, prot, user.jid, args)
-
-for __t in (t for t in globals().values() if isinstance(type, type(t))):
-    if BaseCommand in __t.__mro__:
-        try:
-            i = __t()
-            all_commands[i.name] = i
-        except TypeError, e:
-            # Ignore abstract bases
-            log.msg("Error loading %s: %s" % (__t.__name__, str(e)))
-            pass
+        log.msg("Administrative broadcast from %s" % user.jid)
+        task.coiterate(self._broadcast(prot, user.jid, args)
+                       ).addErrback(log.err)
+
+class CommandRegistry(object):
+    """Commands by name, loaded from a module's namespace on first use."""
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.commands = None
+        self.aliases = None
+
+    def _load(self):
+        self.commands = {}
+        self.aliases = {}
+        for t in (t for t in self.namespace.values()
+                  if isinstance(type, type(t))):
+            if BaseCommand in t.__mro__:
+                try:
+                    i = t()
+                except TypeError, e:
+                    # Ignore abstract bases
+                    log.msg("Error loading %s: %s" % (t.__name__, str(e)))
+                    continue
+                self.commands[i.name] = i
+                self.aliases[i.name] = i
+                for a in i.aliases:
+                    self.aliases[a] = i
+        log.msg("Loaded commands: %s" % `sorted(self.commands.keys())`)
+
+    def lookup(self, name):
+        """Find a command by name or alias."""
+        if self.aliases is None:
+            self._load()
+        return self.aliases.get(name)
+
+    def get(self, name, default=None):
+        if self.commands is None:
+            self._load()
+        return self.commands.get(name, default)
+
+    def __getitem__(self, name):
+        if self.commands is None:
+            self._load()
+        return self.commands[name]
+
+    def keys(self):
+        if self.commands is None:
+            self._load()
+        return self.commands.keys()
+
+all_commands = CommandRegistry(globals())